@@ -0,0 +1,88 @@
+"""
+Benchmark the dtype policy.
+
+For every feature dtype, the California housing data is ingested and given features the way the
+pipeline does it, and the script reports
+- the in memory size of the model input,
+- the size of the model input written as parquet,
+- the fit and predict throughput of the model pipelines,
+- the hold out MAE, and its difference to float64.
+
+The float64 baseline is always benchmarked, also if it is not in `--dtypes`.
+
+Usage:
+    python benchmarks/dtype_policy.py [--dtypes float64 float32] [--models RidgePipelineConfig RandomForestPipelineConfig]
+"""
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import argparse
+import time
+
+from sklearn.metrics import mean_absolute_error
+from sklearn.model_selection import train_test_split
+
+from src.data.add_features import add_features
+from src.data.get_raw_data import TARGET_COLUMN, get_raw_data
+from src.models import model_pipeliene_configs
+from src.utils.dtypes import apply_dtype_policy
+
+
+def model_input(dtype: str):
+    df = get_raw_data()
+    df = apply_dtype_policy(df, features=dtype, target="float64", target_column=TARGET_COLUMN)
+    return add_features(df, dtype=dtype)
+
+
+def parquet_size(df) -> int:
+    with TemporaryDirectory() as tmpdirname:
+        file_path = Path(tmpdirname) / "model_input.parquet"
+        df.to_parquet(file_path)
+        return file_path.stat().st_size
+
+
+def benchmark_model(pipeline_class, df) -> dict:
+    train_df, test_df = train_test_split(df, test_size=0.2, random_state=33)
+    pipeline = pipeline_class.get_pipeline()
+
+    start = time.perf_counter()
+    pipeline.fit(train_df, train_df[TARGET_COLUMN])
+    fit_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    predictions = pipeline.predict(test_df)
+    predict_seconds = time.perf_counter() - start
+
+    return {
+        "fit_rows_per_second": len(train_df) / fit_seconds,
+        "predict_rows_per_second": len(test_df) / predict_seconds,
+        "mae": mean_absolute_error(test_df[TARGET_COLUMN], predictions),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dtypes", nargs="+", default=["float64", "float32"])
+    parser.add_argument("--models", nargs="+", default=["RidgePipelineConfig", "RandomForestPipelineConfig"])
+    args = parser.parse_args()
+
+    dtypes = ["float64"] + [dtype for dtype in args.dtypes if dtype != "float64"]
+    print(f"{'dtype':<10}{'memory (MB)':>14}{'parquet (MB)':>14}")
+    results = {}
+    for dtype in dtypes:
+        df = model_input(dtype)
+        print(f"{dtype:<10}{df.memory_usage(deep=True).sum() / 1e6:>14.2f}{parquet_size(df) / 1e6:>14.2f}")
+        results[dtype] = {model: benchmark_model(getattr(model_pipeliene_configs, model), df) for model in args.models}
+
+    print(f"\n{'dtype':<10}{'model':<30}{'fit rows/s':>14}{'predict rows/s':>16}{'MAE':>10}{'MAE diff':>12}")
+    baseline_mae = {model: result["mae"] for model, result in results["float64"].items()}
+    for dtype, model_results in results.items():
+        for model, result in model_results.items():
+            print(
+                f"{dtype:<10}{model:<30}{result['fit_rows_per_second']:>14.0f}"
+                f"{result['predict_rows_per_second']:>16.0f}{result['mae']:>10.4f}"
+                f"{result['mae'] - baseline_mae[model]:>12.5f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Benchmark the feature matrix prediction path against the pyfunc dataframe path.
+
+The California housing data is ingested and given features the way the pipeline does it, written
+to parquet, and the model pipelines are fitted and saved as mlflow pyfunc models, like the training
+module does. For several batch sizes the script reports the time per row of
+- pyfunc: reading the parquet file with pandas and predicting with the pyfunc model,
+- matrix: reading only the feature columns into a feature matrix and predicting with
+  `predict_feature_matrix`,
+for both reading and predicting, and for predicting alone on data already in memory.
+
+Usage:
+    python benchmarks/predict_path.py [--batch-sizes 1 10 100 1000 10000] [--models RidgePipelineConfig ...]
+"""
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import argparse
+import time
+
+import mlflow.pyfunc
+import numpy as np
+import pandas as pd
+
+from src.data.add_features import add_features
+from src.data.get_raw_data import TARGET_COLUMN, get_raw_data
+from src.models import model_pipeliene_configs
+from src.utils.feature_matrix import (
+    dataframe_to_feature_matrix, predict_feature_matrix, prepare_matrix_pipeline, read_feature_matrix
+)
+from src.utils.models import MLFlowModelWrapper
+
+
+def timed(func, repeats: int) -> float:
+    """Best time of `repeats` calls in seconds."""
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark_model(pipeline_class, df: pd.DataFrame, tmpdirname: str, batch_sizes, repeats: int) -> dict:
+    pipeline = pipeline_class.get_pipeline()
+    pipeline.fit(df, df[TARGET_COLUMN])
+    model_path = str(Path(tmpdirname) / pipeline_class.__name__)
+    mlflow.pyfunc.save_model(python_model=MLFlowModelWrapper(pipeline), path=model_path)
+    pyfunc_model = mlflow.pyfunc.load_model(model_path)
+    columns = list(pipeline["column_selector"].columns)
+    matrix_pipeline = prepare_matrix_pipeline(pipeline, columns)
+
+    results = {}
+    for batch_size in batch_sizes:
+        batch = df.iloc[:batch_size]
+        file_path = str(Path(tmpdirname) / f"batch_{batch_size}.parquet")
+        batch.to_parquet(file_path)
+        matrix = dataframe_to_feature_matrix(batch, columns)
+        np.testing.assert_allclose(pyfunc_model.predict(batch), predict_feature_matrix(matrix_pipeline, matrix))
+
+        results[batch_size] = {
+            "pyfunc_read_predict": timed(lambda: pyfunc_model.predict(pd.read_parquet(file_path)), repeats),
+            "matrix_read_predict": timed(
+                lambda: predict_feature_matrix(matrix_pipeline, read_feature_matrix(file_path, columns)), repeats
+            ),
+            "pyfunc_predict": timed(lambda: pyfunc_model.predict(batch), repeats),
+            "matrix_predict": timed(lambda: predict_feature_matrix(matrix_pipeline, matrix), repeats),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 10, 100, 1000, 10000])
+    parser.add_argument("--models", nargs="+", default=["RidgePipelineConfig", "RandomForestPipelineConfig"])
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    df = add_features(get_raw_data())
+    print(
+        f"{'model':<30}{'rows':>7}"
+        f"{'read+predict us/row':>22}{'matrix':>10}{'predict us/row':>17}{'matrix':>10}{'speedup':>9}"
+    )
+    with TemporaryDirectory() as tmpdirname:
+        for model in args.models:
+            results = benchmark_model(
+                getattr(model_pipeliene_configs, model), df, tmpdirname, args.batch_sizes, args.repeats
+            )
+            for batch_size, result in results.items():
+                per_row = {name: seconds / batch_size * 1e6 for name, seconds in result.items()}
+                print(
+                    f"{model:<30}{batch_size:>7}"
+                    f"{per_row['pyfunc_read_predict']:>22.2f}{per_row['matrix_read_predict']:>10.2f}"
+                    f"{per_row['pyfunc_predict']:>17.2f}{per_row['matrix_predict']:>10.2f}"
+                    f"{result['pyfunc_read_predict'] / result['matrix_read_predict']:>8.1f}x"
+                )
+
+
+if __name__ == "__main__":
+    main()
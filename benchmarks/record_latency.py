@@ -0,0 +1,89 @@
+"""
+Benchmark the latency of scoring a few records.
+
+The California housing data is ingested and given features the way the pipeline does it, and the
+model pipelines are fitted and saved as mlflow pyfunc models, like the training module does.
+For 1, 10 and 100 rows the script reports the p50 and p99 latency of
+- pyfunc: building a dataframe from the records and predicting with the pyfunc model,
+- records: `LoadedModel.predict_records` on the records as dictionaries,
+- numpy: `LoadedModel.predict_records` on the rows as a numpy array.
+
+Usage:
+    python benchmarks/record_latency.py [--n-rows 1 10 100] [--calls 1000] [--models RidgePipelineConfig ...]
+"""
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import argparse
+import time
+
+import mlflow.pyfunc
+import numpy as np
+import pandas as pd
+
+from src.data.add_features import add_features
+from src.data.get_raw_data import TARGET_COLUMN, get_raw_data
+from src.models import model_pipeliene_configs
+from src.utils.models import LoadedModel, MLFlowModelWrapper, ModelMetaData
+
+
+def latencies_us(func, calls: int) -> np.ndarray:
+    func()
+    latencies = np.empty(calls)
+    for i in range(calls):
+        start = time.perf_counter_ns()
+        func()
+        latencies[i] = (time.perf_counter_ns() - start) / 1e3
+    return latencies
+
+
+def load_model(pipeline_class, df: pd.DataFrame, tmpdirname: str) -> LoadedModel:
+    pipeline = pipeline_class.get_pipeline()
+    pipeline.fit(df, df[TARGET_COLUMN])
+    model_path = str(Path(tmpdirname) / pipeline_class.__name__)
+    mlflow.pyfunc.save_model(python_model=MLFlowModelWrapper(pipeline), path=model_path)
+    return LoadedModel(
+        model=mlflow.pyfunc.load_model(model_path),
+        model_meta_data=ModelMetaData(model_id="benchmark", version="v0", run_id="benchmark"),
+        artifact=None,
+        backend=None,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--n-rows", nargs="+", type=int, default=[1, 10, 100])
+    parser.add_argument("--calls", type=int, default=1000)
+    parser.add_argument(
+        "--models",
+        nargs="+",
+        default=["RidgePipelineConfig", "RandomForestPipelineConfig", "HistGradientBoostingPipelineConfig"],
+    )
+    args = parser.parse_args()
+
+    df = add_features(get_raw_data())
+    print(f"{'model':<36}{'rows':>6}  {'path':<9}{'p50 (us)':>12}{'p99 (us)':>12}")
+    with TemporaryDirectory() as tmpdirname:
+        for model in args.models:
+            loaded_model = load_model(getattr(model_pipeliene_configs, model), df, tmpdirname)
+            columns = loaded_model.feature_columns
+            for n_rows in args.n_rows:
+                records = df[columns].iloc[:n_rows].to_dict("records")
+                rows = df[columns].iloc[:n_rows].to_numpy()
+                np.testing.assert_allclose(
+                    loaded_model.model.predict(pd.DataFrame(records)), loaded_model.predict_records(records)
+                )
+                paths = {
+                    "pyfunc": lambda: loaded_model.model.predict(pd.DataFrame(records)),
+                    "records": lambda: loaded_model.predict_records(records),
+                    "numpy": lambda: loaded_model.predict_records(rows),
+                }
+                for path, func in paths.items():
+                    latencies = latencies_us(func, args.calls)
+                    print(
+                        f"{model:<36}{n_rows:>6}  {path:<9}"
+                        f"{np.percentile(latencies, 50):>12.1f}{np.percentile(latencies, 99):>12.1f}"
+                    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Benchmark the startup cost of every `housing-model` subcommand.
+
+Each stage module is imported in a fresh interpreter, the way the CLI does it, and the import
+time together with the heavy dependencies that got pulled in are reported.
+Every stage is also launched once through the CLI with `--cfg job`, which composes its Hydra config
+and exits without running the stage, to check that the entry point finds the config of every stage.
+The script exits with a non zero status if a stage imports a dependency it should only import
+lazily, if its median import time exceeds the budget, or if it cannot be launched.
+
+Usage:
+    python benchmarks/startup_time.py [--repeats 5] [--budget-seconds 2.0]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+from src.cli import STAGES
+
+# Dependencies that must only be imported on the code paths that need them.
+LAZY_DEPENDENCIES = [
+    "wandb",
+    "mlflow",
+    "evidently",
+    "seaborn",
+    "matplotlib",
+    "sklearn.ensemble",
+    "sklearn.datasets",
+]
+
+IMPORT_SNIPPET = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    "seconds": elapsed,
+    "loaded": [m for m in {lazy_dependencies!r} if m in sys.modules],
+}}))
+"""
+
+
+def measure_stage(module: str, repeats: int) -> dict:
+    timings = []
+    loaded = []
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_SNIPPET.format(module=module, lazy_dependencies=LAZY_DEPENDENCIES)],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        timings.append(result["seconds"])
+        loaded = result["loaded"]
+    return {"median_seconds": statistics.median(timings), "loaded": loaded}
+
+
+def launch_stage(stage: str) -> subprocess.CompletedProcess:
+    """Launch a stage through the CLI, printing its composed config instead of running it."""
+    return subprocess.run(
+        [sys.executable, "-m", "src.cli", stage, "--cfg", "job"], capture_output=True, text=True
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--budget-seconds", type=float, default=2.0)
+    args = parser.parse_args()
+
+    failures = []
+    print(f"{'stage':<20}{'median import (s)':>20}  eagerly loaded")
+    for stage, module in STAGES.items():
+        result = measure_stage(module, args.repeats)
+        print(f"{stage:<20}{result['median_seconds']:>20.3f}  {', '.join(result['loaded']) or '-'}")
+        if result["loaded"]:
+            failures.append(f"{stage} eagerly imports {', '.join(result['loaded'])}")
+        if result["median_seconds"] > args.budget_seconds:
+            failures.append(
+                f"{stage} takes {result['median_seconds']:.3f}s to import, budget is {args.budget_seconds}s"
+            )
+        launched = launch_stage(stage)
+        if launched.returncode != 0:
+            failures.append(f"{stage} fails to launch through the CLI:\n{launched.stderr.strip()}")
+
+    if failures:
+        print("\n".join(failures), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Benchmark the training time of the tree based model pipelines.
+
+The California housing data is ingested and given features the way the pipeline does it, and
+optionally repeated to grow the number of rows. For the random forest and the histogram gradient
+boosting pipeline, the script reports the time of the 5 fold cross validation and the fit on all
+data, and the cross validated MAE. The model parameters are the ones in conf/model.
+The folds are grouped by original row, so the copies of a row never end up in both the training
+and the hold out rows of a fold, and the MAE does not depend on the scale.
+
+Usage:
+    python benchmarks/tree_training_time.py [--scales 1 4] [--folds 5]
+"""
+from pathlib import Path
+import argparse
+import time
+
+import numpy as np
+from omegaconf import OmegaConf
+from sklearn.metrics import mean_absolute_error
+from sklearn.model_selection import GroupKFold, cross_val_predict
+
+from src.data.add_features import add_features
+from src.data.get_raw_data import TARGET_COLUMN, get_raw_data
+from src.models import model_pipeliene_configs
+
+MODEL_CONFIG_DIR = Path(__file__).resolve().parents[1] / "conf" / "model"
+
+
+def model_input(scale: int):
+    """Get the model input repeated `scale` times, and the original row of every row."""
+    df = add_features(get_raw_data())
+    original_rows = np.tile(np.arange(len(df)), scale)
+    return df.iloc[original_rows].reset_index(drop=True), original_rows
+
+
+def get_pipeline(model: str):
+    model_config = OmegaConf.load(MODEL_CONFIG_DIR / f"{model}.yaml")
+    pipeline_class = getattr(model_pipeliene_configs, model_config.ml_pipeline_config)
+    return pipeline_class.get_pipeline(**model_config.params)
+
+
+def time_training(pipeline, df, original_rows: np.ndarray, folds: int) -> dict:
+    start = time.perf_counter()
+    predictions = cross_val_predict(
+        pipeline, df, df[TARGET_COLUMN], cv=GroupKFold(n_splits=folds), groups=original_rows
+    )
+    cv_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pipeline.fit(df, df[TARGET_COLUMN])
+    fit_seconds = time.perf_counter() - start
+    return {
+        "cv_seconds": cv_seconds,
+        "fit_seconds": fit_seconds,
+        "mae": mean_absolute_error(df[TARGET_COLUMN], predictions),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", nargs="+", type=int, default=[1, 4])
+    parser.add_argument("--folds", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'rows':>10}  {'model':<34}{'cv (s)':>10}{'fit (s)':>10}{'MAE':>10}")
+    for scale in args.scales:
+        df, original_rows = model_input(scale)
+        results = {
+            model: time_training(get_pipeline(model), df, original_rows, args.folds)
+            for model in ["random_forest", "hist_gradient_boosting"]
+        }
+        for model, result in results.items():
+            print(
+                f"{len(df):>10}  {model:<34}{result['cv_seconds']:>10.2f}"
+                f"{result['fit_seconds']:>10.2f}{result['mae']:>10.4f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
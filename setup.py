@@ -6,4 +6,9 @@ setup(
     version="0.0.1",
     description="Training pipeline.",
     packages=find_packages(),
+    entry_points={
+        "console_scripts": [
+            "housing-model=src.cli:main",
+        ],
+    },
 )
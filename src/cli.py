@@ -0,0 +1,54 @@
+"""
+Single command line entry point for all pipeline stages.
+
+Usage:
+    housing-model <stage> [hydra overrides]
+
+Example:
+    housing-model inference main=inference-pipeline artifacts=inference-pipeline
+
+Stage modules are only imported once the stage has been picked, so running one stage
+never pays the import cost of the dependencies of the other stages.
+"""
+import runpy
+import sys
+
+STAGES = {
+    "get-raw-data": "src.data.get_raw_data",
+    "process-data": "src.data.process_data",
+    "add-features": "src.data.add_features",
+    "validate-data": "src.data.validate_data",
+    "data-segregation": "src.data.data_segregation",
+    "train": "src.models.train_and_evaluate",
+    "promote-model": "src.models.promote_model",
+    "inference": "src.models.inference",
+    "drift-detection": "src.data.feature_drift_detection",
+    "render-drift-report": "src.data.render_drift_report",
+}
+
+
+def _usage() -> str:
+    stages = "\n".join(f"  {stage}" for stage in STAGES)
+    return f"Usage: housing-model <stage> [hydra overrides]\n\nStages:\n{stages}"
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help"):
+        print(_usage())
+        sys.exit(0 if len(sys.argv) >= 2 else 2)
+
+    stage = sys.argv[1]
+    if stage not in STAGES:
+        print(f"Unknown stage: {stage}\n\n{_usage()}", file=sys.stderr)
+        sys.exit(2)
+
+    # Hydra parses sys.argv itself, so the stage name has to be removed before handing over.
+    sys.argv = [sys.argv[0]] + sys.argv[2:]
+    # Run the stage module as __main__, the way `python src/...py` does. Hydra then resolves the
+    # relative config_path against the module file. For an imported module it would look for an
+    # importable `conf` package instead, which does not exist.
+    runpy.run_module(STAGES[stage], run_name="__main__", alter_sys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,44 +1,236 @@
 """
 Module to add features.
+
+Features are declared in a registry together with the input columns they are computed from.
+All features are computed vectorized on the input columns and added to the frame in place,
+so the frame is never copied. Only the features that are requested, the columns selected by the
+`ColumnSelector` of any of the model pipeline configs, are computed. The model input is shared by
+all models, e.g. the model trained next and the prod model used for inference.
 """
+from dataclasses import dataclass
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import hashlib
 import logging
 
 import hydra
+import numpy as np
 import pandas as pd
-import wandb
 
-from src.utils.artifacts import read_dataframe_artifact, log_dataframe
+from src.utils.artifact_backends import get_artifact_backend
+from src.utils.artifacts import get_artifact_file_path, read_dataframe_artifact, log_dataframe, log_file
 
 logger = logging.getLogger(__name__)
 
 
-def add_bedrooms_per_room(df: pd.DataFrame) -> pd.DataFrame:
-    "Add average number of bedrooms per room."
-    df = df.copy()
-    df["avg_bedrooms_per_room"] = df.AveBedrms / df.AveRooms
-    return df
+@dataclass(frozen=True)
+class Feature:
+    """Feature computed from a fixed set of input columns.
+
+    :name: Name of the feature column.
+    :inputs: Names of the input columns. They are passed to `compute` as numpy arrays, in order.
+    :compute: Vectorized function returning the feature values as a numpy array.
+    """
+    name: str
+    inputs: Tuple[str, ...]
+    compute: Callable[..., np.ndarray]
+
+
+FEATURES: Dict[str, Feature] = {}
+
+
+def register_feature(name: str, inputs: Iterable[str]):
+    """Decorator that registers a vectorized feature function under `name`."""
+    def decorator(func: Callable[..., np.ndarray]) -> Callable[..., np.ndarray]:
+        FEATURES[name] = Feature(name=name, inputs=tuple(inputs), compute=func)
+        return func
+    return decorator
+
+
+@register_feature("avg_bedrooms_per_room", inputs=["AveBedrms", "AveRooms"])
+def bedrooms_per_room(ave_bedrooms: np.ndarray, ave_rooms: np.ndarray) -> np.ndarray:
+    "Average number of bedrooms per room."
+    return ave_bedrooms / ave_rooms
+
+
+def get_features(columns: Optional[Iterable[str]] = None) -> List[Feature]:
+    """Get the registered features that are among `columns`. All features if `columns` is None."""
+    if columns is None:
+        return list(FEATURES.values())
+    return [FEATURES[column] for column in columns if column in FEATURES]
+
+
+class FeatureCache:
+    """Local cache of computed features, keyed by a hash of the input columns of a batch."""
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(df: pd.DataFrame, features: List[Feature]) -> str:
+        input_columns = sorted({column for feature in features for column in feature.inputs})
+        hasher = hashlib.sha1()
+        hasher.update(",".join(feature.name for feature in features).encode())
+        hasher.update(",".join(str(df[column].dtype) for column in input_columns).encode())
+        hasher.update(pd.util.hash_pandas_object(df[input_columns], index=False).values.tobytes())
+        return hasher.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.parquet"
+
+    def get(self, key: str) -> Optional[pd.DataFrame]:
+        path = self._path(key)
+        if not path.exists():
+            return None
+        return pd.read_parquet(path)
+
+    def put(self, key: str, feature_df: pd.DataFrame) -> None:
+        tmp_path = self._path(key).with_suffix(".tmp")
+        feature_df.to_parquet(tmp_path, index=False)
+        tmp_path.replace(self._path(key))
 
 
-def add_features(df: pd.DataFrame) -> pd.DataFrame:
-    df = add_bedrooms_per_room(df)
+def _compute_features(df: pd.DataFrame, features: List[Feature], dtype: str) -> Dict[str, np.ndarray]:
+    return {
+        feature.name: np.asarray(
+            feature.compute(*(df[column].to_numpy() for column in feature.inputs))
+        ).astype(dtype, copy=False)
+        for feature in features
+    }
+
+
+def add_features(
+    df: pd.DataFrame,
+    columns: Optional[Iterable[str]] = None,
+    cache: Optional[FeatureCache] = None,
+    dtype: str = "float64",
+) -> pd.DataFrame:
+    """Add registered features to `df` in place.
+
+    :df: Dataframe holding the input columns.
+    :columns: Columns that are needed downstream. Only features among them are computed.
+        All registered features are computed if None.
+    :cache: Optional cache to look up features for identical batches before computing them.
+    :dtype: dtype of the feature columns, set by the dtype policy.
+    :return: The same dataframe, with the feature columns added.
+    """
+    features = get_features(columns)
+    if not features:
+        return df
+
+    key = cache.key(df, features) if cache is not None else None
+    cached = cache.get(key) if cache is not None else None
+    if cached is not None:
+        logger.info(f"Using cached features for batch {key}.")
+        feature_values = {name: cached[name].to_numpy().astype(dtype, copy=False) for name in cached.columns}
+    else:
+        feature_values = _compute_features(df, features, dtype)
+        if cache is not None:
+            cache.put(key, pd.DataFrame(feature_values))
+
+    for name, values in feature_values.items():
+        df[name] = values
     return df
 
 
+def add_features_to_parquet(
+    source_path: str,
+    destination_path: str,
+    columns: Optional[Iterable[str]] = None,
+    batch_size: int = 65536,
+    dtype: str = "float64",
+) -> None:
+    """Add registered features to a parquet file, one Arrow record batch at a time.
+
+    Memory use is bounded by `batch_size` rows, independent of the size of the file.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    features = get_features(columns)
+    source = pq.ParquetFile(source_path)
+    schema = source.schema_arrow
+    feature_type = pa.from_numpy_dtype(np.dtype(dtype))
+    for feature in features:
+        schema = schema.append(pa.field(feature.name, feature_type))
+
+    with pq.ParquetWriter(destination_path, schema) as writer:
+        for batch in source.iter_batches(batch_size=batch_size):
+            arrays = list(batch.columns)
+            for feature in features:
+                inputs = (
+                    batch.column(batch.schema.get_field_index(column)).to_numpy(zero_copy_only=False)
+                    for column in feature.inputs
+                )
+                values = np.asarray(feature.compute(*inputs)).astype(dtype, copy=False)
+                arrays.append(pa.array(values, type=feature_type))
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+
+def get_model_feature_columns() -> List[str]:
+    """Get the union of the columns selected by the `ColumnSelector` of every model pipeline config."""
+    from src.models import model_pipeliene_configs
+    from src.models.model_pipeliene_configs import BasePipelineConfig
+
+    pipeline_classes = [
+        value for value in vars(model_pipeliene_configs).values()
+        if isinstance(value, type) and issubclass(value, BasePipelineConfig) and value is not BasePipelineConfig
+    ]
+    return list(dict.fromkeys(
+        column
+        for pipeline_class in pipeline_classes
+        for column in pipeline_class.get_pipeline()["column_selector"].columns
+    ))
+
+
 @hydra.main(config_path="../../conf", config_name="config")
 def main(config):
+    import wandb
+
     with wandb.init(
         project=config["main"]["project_name"],
         job_type="add_features",
-        group=config["main"]["experiment_name"]
+        group=config["main"]["experiment_name"],
+        mode=config["artifact_backend"]["wandb_mode"],
     ) as run:
+        backend = get_artifact_backend(config, run)
+
+        columns = get_model_feature_columns()
+        batch_size = config["main"].get("feature_batch_size", None)
+
+        if batch_size:
+            source_path = get_artifact_file_path(backend, **config["artifacts"]["clean_data"])
+
+            logger.info('Add features in batches.')
+            with TemporaryDirectory() as tmpdirname:
+                destination_path = str(Path(tmpdirname) / "artifacts.parquet")
+                add_features_to_parquet(
+                    source_path,
+                    destination_path,
+                    columns=columns,
+                    batch_size=batch_size,
+                    dtype=config["dtypes"]["features"],
+                )
+
+                logger.info('Log modelling input.')
+                log_file(backend=backend, file_path=destination_path, **config["artifacts"]["model_input"])
+            return
 
-        df = read_dataframe_artifact(run, **config["artifacts"]["clean_data"])
+        df = read_dataframe_artifact(backend, **config["artifacts"]["clean_data"])
 
         logger.info('Add features.')
-        df = add_features(df)
+        cache_dir = config["main"].get("feature_cache_dir", None)
+        df = add_features(
+            df,
+            columns=columns,
+            cache=FeatureCache(cache_dir) if cache_dir else None,
+            dtype=config["dtypes"]["features"],
+        )
 
         logger.info('Log modelling input.')
-        log_dataframe(run=run, df=df, **config["artifacts"]["model_input"])
+        log_dataframe(backend=backend, df=df, **config["artifacts"]["model_input"])
 
 
 if __name__ == "__main__":
@@ -2,33 +2,108 @@
 Module to split modelling data into
 - One data set for training and validation
 - One hold out dataset for the final model performance evaluation
+
+Two split modes are supported, set with `evaluation.split_mode`:
+- random: A random split. Both data sets are logged as full copies of the rows.
+- hash: Rows are assigned to the test set based on a stable hash of a row key, so a row keeps its
+  assignment when the data is refreshed. Both data sets are logged as bitmaps pointing into the
+  model input artifact.
 """
 import logging
 
 import hydra
-import wandb
-from sklearn.model_selection import train_test_split
+import numpy as np
+import pandas as pd
 
-from src.utils.artifacts import read_dataframe_artifact, log_dataframe
-from src.utils.models import set_seed
+from src.utils.artifact_backends import get_artifact_backend
+from src.utils.artifacts import read_dataframe_artifact, log_dataframe, log_row_selection, use_artifact
+from src.utils.seed import set_seed
 
 logger = logging.getLogger(__name__)
 
 
+def canonical_keys(keys: pd.DataFrame, decimals: int = 4) -> pd.DataFrame:
+    """Bring numeric key columns to float64 rounded to `decimals`, so a key hashes the same
+    whatever the dtype policy the data was stored with, e.g. float32 or float64.
+    float32 holds about 7 significant digits, so `decimals` must leave room for the integer digits."""
+    numeric_columns = [
+        column for column in keys.select_dtypes(include="number").columns
+        if not pd.api.types.is_bool_dtype(keys[column])
+    ]
+    return keys.astype({column: np.float64 for column in numeric_columns}).round(
+        {column: decimals for column in numeric_columns}
+    )
+
+
+def hash_split_mask(keys: pd.DataFrame, test_set_ratio: float, decimals: int = 4) -> np.ndarray:
+    """Get a boolean mask that is True for the rows assigned to the test set.
+
+    The assignment of a row only depends on its key, so it can be computed chunk by chunk
+    while streaming and does not change when other rows are added or removed.
+    :keys: Dataframe with the key columns. The index is used as key if there are no columns,
+        which is only stable across refreshes if the index is a stable row id, not a positional index.
+    :test_set_ratio: Expected fraction of rows assigned to the test set.
+    :decimals: Numeric keys are rounded to this many decimals before hashing, see `canonical_keys`.
+    """
+    if keys.shape[1] == 0:
+        logger.warning(
+            "No split key columns. Splitting on the index, which only keeps rows in the same split "
+            "across data refreshes if the index is a stable row id."
+        )
+        hashes = pd.util.hash_pandas_object(keys.index, index=False).to_numpy()
+    else:
+        hashes = pd.util.hash_pandas_object(canonical_keys(keys, decimals), index=False).to_numpy()
+    # Use the top 53 bits of the hash as a uniform number in [0, 1).
+    uniform = (hashes >> np.uint64(11)).astype(np.float64) / float(2 ** 53)
+    return uniform < test_set_ratio
+
+
 @hydra.main(config_path="../../conf", config_name="config")
 def main(config):
+    import wandb
+    from sklearn.model_selection import train_test_split
+
     with wandb.init(
         project=config["main"]["project_name"],
         job_type="data_segregation",
-        group=config["main"]["experiment_name"]
+        group=config["main"]["experiment_name"],
+        mode=config["artifact_backend"]["wandb_mode"],
     ) as run:
+        backend = get_artifact_backend(config, run)
 
         logger.info("Fix seed.")
         seed = set_seed()
         run.log({"seed": seed})
 
+        if config["evaluation"].get("split_mode", "random") == "hash":
+            logger.info('Load key columns of modelling data.')
+            model_input_artifact = use_artifact(backend, **config["artifacts"]["model_input"])
+            keys = pd.read_parquet(
+                model_input_artifact.file(),
+                columns=list(config["evaluation"].get("split_key_columns", None) or []),
+            )
+
+            logger.info('Split data in train/validate and test data by hashed row key.')
+            test_mask = hash_split_mask(
+                keys,
+                config["evaluation"]["test_set_ratio"],
+                decimals=config["evaluation"].get("split_key_decimals", 4),
+            )
+            run.log({"n_train_validate_rows": int((~test_mask).sum()), "n_test_rows": int(test_mask.sum())})
+
+            logger.info('Log train/validate and test row selections.')
+            source = dict(
+                source_name=config["artifacts"]["model_input"]["name"],
+                source_version=model_input_artifact.version,
+            )
+            log_row_selection(
+                backend=backend, mask=~test_mask, **source, **config["artifacts"]["train_validate_data"]
+            )
+            log_row_selection(backend=backend, mask=test_mask, **source, **config["artifacts"]["test_data"])
+            return
+
         logger.info('Load modelling data.')
-        df = read_dataframe_artifact(run, **config["artifacts"]["model_input"])
+        df = read_dataframe_artifact(backend, **config["artifacts"]["model_input"])
 
         logger.info('Split data in train/validate and test data.')
         train_validate_df, test_df = train_test_split(
@@ -37,8 +112,8 @@ def main(config):
         )
 
         logger.info('Log train/validate and test data.')
-        log_dataframe(run=run, df=train_validate_df, **config["artifacts"]["train_validate_data"])
-        log_dataframe(run=run, df=test_df, **config["artifacts"]["test_data"])
+        log_dataframe(backend=backend, df=train_validate_df, **config["artifacts"]["train_validate_data"])
+        log_dataframe(backend=backend, df=test_df, **config["artifacts"]["test_data"])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,313 @@
+"""
+Module with a native feature drift engine.
+
+The statistical tests are computed vectorized across all numerical columns at once, with the
+columns split in chunks that are processed in parallel. Per column it computes
+- the two sample Kolmogorov-Smirnov statistic and p-value,
+- the population stability index (PSI) over reference quantile bins,
+- the Wasserstein distance, normed by the standard deviation of the reference.
+
+A column is drifted according to the selected test:
+- ks: p-value below the threshold (default 0.05).
+- psi: PSI above the threshold (default 0.1).
+- wasserstein: normed Wasserstein distance above the threshold (default 0.1).
+"""
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_THRESHOLDS = {
+    "ks": 0.05,
+    "psi": 0.1,
+    "wasserstein": 0.1,
+}
+
+# Same cut off as scipy.stats.ks_2samp uses to pick exact p-values over the asymptotic ones.
+MAX_EXACT_KS_SAMPLE_SIZE = 10000
+
+
+@dataclass
+class FeatureDrift:
+    """Drift test results for a single feature."""
+    ks_statistic: float
+    ks_p_value: float
+    psi: float
+    wasserstein_normed: float
+    drifted: bool
+
+
+@dataclass
+class DriftProfile:
+    """Drift test results for all features.
+
+    :error_bound: Upper bound on the absolute error of the KS statistics introduced by
+        subsampling the reference data. 0 if the full reference data was used.
+    """
+    stattest: str
+    threshold: float
+    n_reference_rows: int
+    n_current_rows: int
+    reference_sample_size: Optional[int]
+    error_bound: float
+    features: Dict[str, FeatureDrift]
+
+    @property
+    def n_features(self) -> int:
+        return len(self.features)
+
+    @property
+    def n_drifted_features(self) -> int:
+        return sum(feature.drifted for feature in self.features.values())
+
+    @property
+    def share_drifted_features(self) -> float:
+        return self.n_drifted_features / self.n_features if self.n_features else 0.0
+
+    def to_dict(self) -> dict:
+        profile = asdict(self)
+        profile.update(
+            n_features=self.n_features,
+            n_drifted_features=self.n_drifted_features,
+            share_drifted_features=self.share_drifted_features,
+        )
+        return profile
+
+    def json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    @classmethod
+    def from_dict(cls, profile: dict) -> "DriftProfile":
+        return cls(
+            stattest=profile["stattest"],
+            threshold=profile["threshold"],
+            n_reference_rows=profile["n_reference_rows"],
+            n_current_rows=profile["n_current_rows"],
+            reference_sample_size=profile["reference_sample_size"],
+            error_bound=profile["error_bound"],
+            features={
+                name: FeatureDrift(**feature) for name, feature in profile["features"].items()
+            },
+        )
+
+
+def stratified_reference_sample(reference: np.ndarray, sample_size: int) -> np.ndarray:
+    """Subsample every column of the reference data, stratified by rank.
+
+    Each column is split in `sample_size` strata of equal frequency, and every stratum is
+    represented by its middle order statistic. The empirical CDF of the sample is therefore
+    within 1 / sample_size of the empirical CDF of the full column, everywhere, so the KS
+    statistic computed on the sample is within 1 / sample_size of the full data value.
+    """
+    n_rows = reference.shape[0]
+    if sample_size >= n_rows:
+        return reference
+    kth = ((np.arange(sample_size) + 0.5) * n_rows / sample_size).astype(np.int64)
+    return np.partition(reference, kth, axis=0)[kth]
+
+
+def _ks_and_wasserstein(reference: np.ndarray, current: np.ndarray):
+    """KS statistics and Wasserstein distances for every column of two 2d arrays."""
+    n_reference, n_current = reference.shape[0], current.shape[0]
+    combined = np.concatenate([reference, current], axis=0)
+    order = np.argsort(combined, axis=0, kind="mergesort")
+    sorted_values = np.take_along_axis(combined, order, axis=0)
+
+    from_reference = order < n_reference
+    cdf_difference = np.abs(
+        np.cumsum(from_reference, axis=0) / n_reference - np.cumsum(~from_reference, axis=0) / n_current
+    )
+    steps = np.diff(sorted_values, axis=0)
+
+    # The empirical CDFs are only compared after the last of a run of tied values.
+    after_last_tie = np.vstack([steps != 0, np.ones((1, combined.shape[1]), dtype=bool)])
+    ks_statistic = np.where(after_last_tie, cdf_difference, 0.0).max(axis=0)
+    wasserstein = (cdf_difference[:-1] * steps).sum(axis=0)
+    return ks_statistic, wasserstein
+
+
+def _psi(reference: np.ndarray, current: np.ndarray, n_bins: int = 10) -> np.ndarray:
+    """Population stability index for every column, using quantile bins of the reference."""
+    n_columns = reference.shape[1]
+    edges = np.quantile(reference, np.linspace(0, 1, n_bins + 1)[1:-1], axis=0)
+    column_offsets = np.arange(n_columns) * n_bins
+
+    def bin_proportions(values: np.ndarray) -> np.ndarray:
+        bins = np.zeros(values.shape, dtype=np.int64)
+        for edge in edges:
+            bins += values > edge
+        counts = np.bincount((bins + column_offsets).ravel(), minlength=n_columns * n_bins)
+        return np.clip(counts.reshape(n_columns, n_bins).T / values.shape[0], 1e-4, None)
+
+    reference_proportions = bin_proportions(reference)
+    current_proportions = bin_proportions(current)
+    return (
+        (current_proportions - reference_proportions)
+        * np.log(current_proportions / reference_proportions)
+    ).sum(axis=0)
+
+
+def _ks_p_values(
+    ks_statistic: np.ndarray,
+    reference: np.ndarray,
+    current: np.ndarray,
+    n_reference: int,
+) -> np.ndarray:
+    """p-values of the KS statistics, computed the way scipy.stats.ks_2samp does by default."""
+    from scipy import stats
+
+    n_current = current.shape[0]
+    if max(n_reference, n_current) <= MAX_EXACT_KS_SAMPLE_SIZE and reference.shape[0] == n_reference:
+        return np.array([
+            stats.ks_2samp(reference[:, i], current[:, i]).pvalue for i in range(reference.shape[1])
+        ])
+    effective_n = np.round(n_reference * n_current / (n_reference + n_current))
+    return np.clip(stats.kstwo.sf(ks_statistic, effective_n), 0.0, 1.0)
+
+
+def _column_chunk_tests(reference: np.ndarray, current: np.ndarray, n_reference: int) -> Dict[str, np.ndarray]:
+    ks_statistic, wasserstein = _ks_and_wasserstein(reference, current)
+    reference_std = reference.std(axis=0)
+    return {
+        "ks_statistic": ks_statistic,
+        "ks_p_value": _ks_p_values(ks_statistic, reference, current, n_reference),
+        "psi": _psi(reference, current),
+        "wasserstein_normed": wasserstein / np.where(reference_std > 0, reference_std, 1.0),
+    }
+
+
+def _is_drifted(stattest: str, threshold: float, tests: Dict[str, float]) -> bool:
+    if stattest == "ks":
+        return tests["ks_p_value"] < threshold
+    if stattest == "psi":
+        return tests["psi"] > threshold
+    if stattest == "wasserstein":
+        return tests["wasserstein_normed"] > threshold
+    raise ValueError(f"Unknown drift stattest {stattest}. Use one of {list(DEFAULT_THRESHOLDS)}.")
+
+
+def get_drift_columns(reference_data: pd.DataFrame, current_data: pd.DataFrame) -> List[str]:
+    """Numerical columns present in both data sets."""
+    return [
+        column for column in reference_data.select_dtypes("number").columns
+        if column in current_data.columns
+    ]
+
+
+def detect_drift(
+    reference_data: pd.DataFrame,
+    current_data: pd.DataFrame,
+    columns: Optional[List[str]] = None,
+    stattest: str = "ks",
+    threshold: Optional[float] = None,
+    reference_sample_size: Optional[int] = None,
+    n_jobs: int = -1,
+) -> DriftProfile:
+    """Test all columns for drift between reference and current data.
+
+    :columns: Columns to test. All numerical columns in both data sets if None.
+    :stattest: Test deciding whether a column is drifted, one of ks, psi and wasserstein.
+    :threshold: Threshold for the test. Defaults to DEFAULT_THRESHOLDS[stattest].
+    :reference_sample_size: Subsample the reference data to this many rows per column,
+        stratified by rank. See `stratified_reference_sample` for the error bound.
+    :n_jobs: Number of threads the columns are split over. -1 to use all cores.
+    Raises ValueError if the reference or current data of a column has no rows, as no test can tell
+    whether it drifted.
+    """
+    if stattest not in DEFAULT_THRESHOLDS:
+        raise ValueError(f"Unknown drift stattest {stattest}. Use one of {list(DEFAULT_THRESHOLDS)}.")
+    threshold = DEFAULT_THRESHOLDS[stattest] if threshold is None else threshold
+    columns = get_drift_columns(reference_data, current_data) if columns is None else list(columns)
+    n_jobs = os.cpu_count() if n_jobs == -1 else max(n_jobs, 1)
+
+    # Columns without missing values are tested together, the others one by one after dropping them.
+    has_missing = reference_data[columns].isna().any() | current_data[columns].isna().any()
+    complete_columns = [column for column in columns if not has_missing[column]]
+    column_groups = [
+        chunk.tolist() for chunk in np.array_split(np.array(complete_columns, dtype=object), n_jobs) if len(chunk)
+    ] + [[column] for column in columns if has_missing[column]]
+
+    def test_group(group: List[str]) -> Dict[str, Dict[str, float]]:
+        reference = reference_data[group].dropna().to_numpy(dtype=np.float64)
+        current = current_data[group].dropna().to_numpy(dtype=np.float64)
+        if reference.shape[0] == 0 or current.shape[0] == 0:
+            raise ValueError(
+                f"Cannot test {group} for drift, the reference data has {reference.shape[0]} rows "
+                f"and the current data {current.shape[0]} rows with values."
+            )
+        n_reference = reference.shape[0]
+        if reference_sample_size:
+            reference = stratified_reference_sample(reference, reference_sample_size)
+        tests = _column_chunk_tests(reference, current, n_reference)
+        return {
+            column: {name: float(values[i]) for name, values in tests.items()}
+            for i, column in enumerate(group)
+        }
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        group_results = list(executor.map(test_group, column_groups))
+
+    results = {column: tests for group_result in group_results for column, tests in group_result.items()}
+    subsampled = bool(reference_sample_size) and reference_sample_size < len(reference_data)
+    return DriftProfile(
+        stattest=stattest,
+        threshold=threshold,
+        n_reference_rows=len(reference_data),
+        n_current_rows=len(current_data),
+        reference_sample_size=reference_sample_size if subsampled else None,
+        error_bound=1 / reference_sample_size if subsampled else 0.0,
+        features={
+            column: FeatureDrift(**results[column], drifted=_is_drifted(stattest, threshold, results[column]))
+            for column in columns
+        },
+    )
+
+
+def _render_feature_row(name: str, feature: FeatureDrift) -> str:
+    row_class = "drifted" if feature.drifted else "not-drifted"
+    return (
+        f'<tr class="{row_class}">'
+        f"<td>{name}</td><td>{feature.ks_statistic:.4f}</td><td>{feature.ks_p_value:.4g}</td>"
+        f"<td>{feature.psi:.4f}</td><td>{feature.wasserstein_normed:.4f}</td>"
+        f"<td>{'yes' if feature.drifted else 'no'}</td></tr>"
+    )
+
+
+def render_drift_report(profile: DriftProfile) -> str:
+    """Render a drift profile as a standalone HTML report."""
+    rows = "\n".join(_render_feature_row(name, feature) for name, feature in profile.features.items())
+    subsampling = (
+        f"<p>Reference subsampled to {profile.reference_sample_size} rows per feature. "
+        f"KS statistics are within {profile.error_bound:.4g} of their full data values.</p>"
+        if profile.reference_sample_size else ""
+    )
+    return f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Data drift report</title>
+<style>
+body {{ font-family: sans-serif; }}
+table {{ border-collapse: collapse; }}
+td, th {{ border: 1px solid #ccc; padding: 4px 8px; text-align: right; }}
+td:first-child {{ text-align: left; }}
+tr.drifted {{ background-color: #f8d7da; }}
+</style>
+</head>
+<body>
+<h1>Data drift report</h1>
+<p>Drift detected for {profile.n_drifted_features} of {profile.n_features} features,
+using the {profile.stattest} test with threshold {profile.threshold}.</p>
+<p>Reference rows: {profile.n_reference_rows}. Current rows: {profile.n_current_rows}.</p>
+{subsampling}
+<table>
+<tr><th>Feature</th><th>KS statistic</th><th>KS p-value</th><th>PSI</th><th>Normed Wasserstein</th><th>Drifted</th></tr>
+{rows}
+</table>
+</body>
+</html>
+"""
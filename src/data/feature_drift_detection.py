@@ -1,74 +1,109 @@
 """
 Module for doing drift detection
+
+Two drift engines are supported, set with `main.drift_engine`:
+- native: The vectorized drift tests in `src.data.drift`, computed once for both the report and the profile.
+- evidently: Evidently AI dashboard and profile.
+
+The JSON profile is always logged. When the HTML report is rendered is set with `main.drift_report`:
+- on_drift: Only when drift is detected, so the routine case stays cheap.
+- always: On every run.
+- never: Never. Use the `render-drift-report` stage to render it from a stored profile on demand.
+
+The current data is read with `main.drift_current_data`:
+- store: The features of the last `main.drift_window_days` days in the predictions store.
+- artifact: The latest model input artifact of the inference pipeline.
 """
+from pathlib import Path
 from tempfile import TemporaryDirectory
 import logging
 
 import hydra
 import pandas as pd
-import wandb
-from evidently.analyzers.data_drift_analyzer import DataDriftAnalyzer
-from evidently.dashboard import Dashboard
-from evidently.dashboard.tabs import DataDriftTab
-from evidently.model_profile.sections import DataDriftProfileSection
-from evidently.model_profile import Profile
 
+from src.data.drift import detect_drift, render_drift_report
+from src.utils.artifact_backends import ArtifactBackend, get_artifact_backend
 from src.utils.artifacts import read_dataframe_artifact, log_file
+from src.utils.predictions_store import FEATURES_TABLE, PredictionsStore
 
 logger = logging.getLogger(__name__)
 
+DRIFT_REPORT_OPTIONS = ["on_drift", "always", "never"]
 
-def get_model_training_data(run, project_name, model_name, model_version) -> pd.DataFrame:
+
+def get_model_training_data(backend: ArtifactBackend, model_name, model_version) -> pd.DataFrame:
     """Get training data used to train a specific model"""
-    api = wandb.Api()
-    try:
-        artifact = api.artifact(f"{project_name}/{model_name}:{model_version}")
-    except wandb.errors.CommError as e:
-        raise ValueError(f"Trained model version does not exist. From WANDB: {e}")
-    training_run = artifact.logged_by()
-    training_data_artifact_name_and_version =  training_run.used_artifacts()[0]._artifact_name
+    model_artifact = backend.get_artifact(model_name, model_version)
+    training_data_artifact_name_and_version = backend.lineage(model_artifact.name, model_artifact.version)[0]
     training_data_artifact_name, training_data_artifact_version = (
         training_data_artifact_name_and_version.split(":")
     )
     return read_dataframe_artifact(
-        run, name=training_data_artifact_name, version=training_data_artifact_version
+        backend, name=training_data_artifact_name, version=training_data_artifact_version
     )
 
 
-@hydra.main(config_path="../../conf", config_name="config")
-def main(config):
-    run = wandb.init(
-        project=config["main"]["project_name"],
-        job_type="drift_detection",
-        group=config["main"]["experiment_name"],
-    )
-    training_data = get_model_training_data(
-        run=run,
-        project_name=config["main"]["project_name"],
-        model_name=config['artifacts']['model']['name'],
-        model_version=config['artifacts']['model']['version'],
+def log_text_file(backend: ArtifactBackend, text: str, file_name: str, **artifact) -> None:
+    """Write text to a temporary file and log it as a file artifact."""
+    with TemporaryDirectory() as tmpdirname:
+        file_path = str(Path(tmpdirname) / file_name)
+        with open(file_path, "w") as file:
+            file.write(text)
+        log_file(backend=backend, file_path=file_path, **artifact)
+
+
+def should_render_report(drift_report: str, n_drifted_features: int) -> bool:
+    if drift_report not in DRIFT_REPORT_OPTIONS:
+        raise ValueError(f"Unknown drift_report option {drift_report}. Use one of {DRIFT_REPORT_OPTIONS}.")
+    return drift_report == "always" or (drift_report == "on_drift" and n_drifted_features > 0)
+
+
+def native_drift_detection(
+    backend: ArtifactBackend, training_data: pd.DataFrame, inference_data: pd.DataFrame, config
+) -> int:
+    """Run the native drift engine, log the profile, and the report if needed.
+    Returns the number of drifted features.
+    """
+    logger.info("Calculate data drift profile.")
+    data_drift_profile = detect_drift(
+        reference_data=training_data,
+        current_data=inference_data,
+        stattest=config["main"].get("drift_stattest", "ks"),
+        threshold=config["main"].get("drift_threshold", None),
+        reference_sample_size=config["main"].get("drift_reference_sample_size", None),
+        n_jobs=config["main"].get("drift_n_jobs", -1),
     )
 
-    # Get data supposed to represent a batch of recent data used for inference.
-    # Most likely implemented as a rolling window. In this case we are just getting
-    # data from the last batch inference.
-    logger.info("Load data used for inference.")
-    inference_data = read_dataframe_artifact(run=run, **config['artifacts']['model_input'])
-
-    logger.info("Create and log data drift report.")
-    data_drift_report = Dashboard(tabs=[DataDriftTab()])
-    data_drift_report.calculate(
-        reference_data=training_data,
-        current_data=inference_data
+    logger.info("Log data drift profile.")
+    log_text_file(
+        backend,
+        data_drift_profile.json(),
+        "data_drift_profile.json",
+        **config["artifacts"]["feature_drift_profile"],
     )
-    with TemporaryDirectory() as tmpdirname:
-        data_drift_report_file_name = tmpdirname + "data_drift_report.html"
-        data_drift_report.save(data_drift_report_file_name)
-        log_file(
-            run=run,
-            file_path=data_drift_report_file_name,
-            **config["artifacts"]["feature_drift_report"]
+
+    if should_render_report(config["main"].get("drift_report", "on_drift"), data_drift_profile.n_drifted_features):
+        logger.info("Render and log data drift report.")
+        log_text_file(
+            backend,
+            render_drift_report(data_drift_profile),
+            "data_drift_report.html",
+            **config["artifacts"]["feature_drift_report"],
         )
+    return data_drift_profile.n_drifted_features
+
+
+def evidently_drift_detection(
+    backend: ArtifactBackend, training_data: pd.DataFrame, inference_data: pd.DataFrame, config
+) -> int:
+    """Run Evidently AI drift detection, log the profile, and the report if needed.
+    Returns the number of drifted features.
+    """
+    from evidently.analyzers.data_drift_analyzer import DataDriftAnalyzer
+    from evidently.dashboard import Dashboard
+    from evidently.dashboard.tabs import DataDriftTab
+    from evidently.model_profile.sections import DataDriftProfileSection
+    from evidently.model_profile import Profile
 
     logger.info("Create and log data drift profile.")
     data_drift_profile = Profile(sections=[DataDriftProfileSection()])
@@ -76,19 +111,83 @@ def main(config):
         reference_data=training_data,
         current_data=inference_data
     )
-    with TemporaryDirectory() as tmpdirname:
-        data_drift_profile_file_name = f'{tmpdirname}data_drift_profile.json'
-        with open(data_drift_profile_file_name, "w") as file:
-            file.write(data_drift_profile.json())
-        log_file(
-            run=run,
-            file_path=data_drift_profile_file_name,
-            **config["artifacts"]["feature_drift_profile"]
-        )
+    log_text_file(
+        backend,
+        data_drift_profile.json(),
+        "data_drift_profile.json",
+        **config["artifacts"]["feature_drift_profile"],
+    )
 
     # Get number of drifted features from analyzer
     n_drifted_features = data_drift_profile.analyzers_results[DataDriftAnalyzer].metrics.n_drifted_features
 
+    if should_render_report(config["main"].get("drift_report", "on_drift"), n_drifted_features):
+        logger.info("Create and log data drift report.")
+        data_drift_report = Dashboard(tabs=[DataDriftTab()])
+        data_drift_report.calculate(
+            reference_data=training_data,
+            current_data=inference_data
+        )
+        with TemporaryDirectory() as tmpdirname:
+            data_drift_report_file_name = str(Path(tmpdirname) / "data_drift_report.html")
+            data_drift_report.save(data_drift_report_file_name)
+            log_file(
+                backend=backend,
+                file_path=data_drift_report_file_name,
+                **config["artifacts"]["feature_drift_report"]
+            )
+    return n_drifted_features
+
+
+@hydra.main(config_path="../../conf", config_name="config")
+def main(config):
+    import wandb
+
+    run = wandb.init(
+        project=config["main"]["project_name"],
+        job_type="drift_detection",
+        group=config["main"]["experiment_name"],
+        mode=config["artifact_backend"]["wandb_mode"],
+    )
+    backend = get_artifact_backend(config, run)
+    training_data = get_model_training_data(
+        backend=backend,
+        model_name=config['artifacts']['model']['name'],
+        model_version=config['artifacts']['model']['version'],
+    )
+
+    if config["main"].get("drift_current_data", "store") == "store":
+        from hydra.utils import to_absolute_path
+
+        window_days = config["main"]["drift_window_days"]
+        logger.info(f"Load features used for inference in the last {window_days} days.")
+        store = PredictionsStore(to_absolute_path(config["main"]["predictions_store_dir"]))
+        inference_data = store.read_window(FEATURES_TABLE, days=window_days).drop(columns="row_key")
+    else:
+        logger.info("Load data used for inference.")
+        inference_data = read_dataframe_artifact(backend=backend, **config['artifacts']['model_input'])
+
+    # The features table has no target, so both engines compare only the columns the data sets share.
+    shared_columns = [column for column in inference_data.columns if column in training_data.columns]
+    training_data = training_data[shared_columns]
+    inference_data = inference_data[shared_columns]
+
+    if training_data.empty or inference_data.empty:
+        # No data is not the same as no drift, so this is reported instead of passing silently.
+        error_text = (
+            f"Cannot detect drift with {len(training_data)} training rows and {len(inference_data)} "
+            f"inference rows in {len(shared_columns)} shared columns. Check that inference ran recently."
+        )
+        logger.error(error_text)
+        wandb.alert(title="Drift detection has no data.", text=error_text, level=wandb.AlertLevel.ERROR)
+        raise ValueError(error_text)
+
+    if config["main"].get("drift_engine", "native") == "evidently":
+        n_drifted_features = evidently_drift_detection(backend, training_data, inference_data, config)
+    else:
+        n_drifted_features = native_drift_detection(backend, training_data, inference_data, config)
+    run.log({"n_drifted_features": n_drifted_features})
+
     if n_drifted_features > 0:
         warning_text = (
             f"Feature drift detected for {n_drifted_features} features. "
@@ -104,5 +203,3 @@ def main(config):
 
 if __name__ == '__main__':
     main()
-
-
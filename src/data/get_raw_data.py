@@ -5,14 +5,16 @@ from typing import Optional
 import logging
 
 import hydra
-import wandb
-from sklearn.datasets import fetch_california_housing
 import pandas as pd
 
+from src.utils.artifact_backends import get_artifact_backend
 from src.utils.artifacts import log_dataframe
+from src.utils.dtypes import apply_dtype_policy
 
 logger = logging.getLogger(__name__)
 
+TARGET_COLUMN = "median_house_price"
+
 
 def get_raw_data(
     sample_size: Optional[int] = None,
@@ -20,10 +22,12 @@ def get_raw_data(
     **kwargs
     ) -> pd.DataFrame:
     """Get california housing data."""
+    from sklearn.datasets import fetch_california_housing
+
     _ = kwargs
     data = fetch_california_housing(as_frame=True)
     df = data.data
-    df["median_house_price"] = data.target
+    df[TARGET_COLUMN] = data.target
     if med_inc_mean_drift_percentage:
         df["MedInc"] = df["MedInc"] * (1 + med_inc_mean_drift_percentage)
     if sample_size:
@@ -33,19 +37,27 @@ def get_raw_data(
 
 @hydra.main(config_path="../../conf", config_name="config")
 def main(config):
+    import wandb
+
     with wandb.init(
         project=config["main"]["project_name"],
         job_type="get-raw-data",
-        group=config["main"]["experiment_name"]
+        group=config["main"]["experiment_name"],
+        mode=config["artifact_backend"]["wandb_mode"],
     ) as run:
+        backend = get_artifact_backend(config, run)
+
         logger.info("Get sample inference data.")
         df = get_raw_data(
             sample_size=config["main"].get("inference_sample_size", None),
             med_inc_mean_drift_percentage=config["main"].get("med_inc_mean_drift_percentage", None)
         )
+
+        logger.info("Apply dtype policy.")
+        df = apply_dtype_policy(df, target_column=TARGET_COLUMN, **config["dtypes"])
         
         logger.info("Log raw data")
-        log_dataframe(run=run, df=df, **config["artifacts"]["raw_data"])
+        log_dataframe(backend=backend, df=df, **config["artifacts"]["raw_data"])
 
 
 if __name__ == "__main__":
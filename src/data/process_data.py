@@ -5,8 +5,8 @@ import logging
 
 import hydra
 import pandas as pd
-import wandb
 
+from src.utils.artifact_backends import get_artifact_backend
 from src.utils.artifacts import log_dataframe, read_dataframe_artifact
 
 logger = logging.getLogger(__name__)
@@ -18,18 +18,23 @@ def preprocess(df: pd.DataFrame) -> pd.DataFrame:
 
 @hydra.main(config_path="../../conf", config_name="config")
 def main(config):
+    import wandb
+
     with wandb.init(
         project=config["main"]["project_name"],
         job_type="process-data",
-        group=config["main"]["experiment_name"]
+        group=config["main"]["experiment_name"],
+        mode=config["artifact_backend"]["wandb_mode"],
     ) as run:
-        df = read_dataframe_artifact(run, **config["artifacts"]["raw_data"])
+        backend = get_artifact_backend(config, run)
+
+        df = read_dataframe_artifact(backend, **config["artifacts"]["raw_data"])
 
         logger.info('Preprocess raw artifacts.')
         df = preprocess(df)
 
         logger.info('Log preprocessed artifacts.')
-        log_dataframe(run=run, df=df, **config["artifacts"]["clean_data"])
+        log_dataframe(backend=backend, df=df, **config["artifacts"]["clean_data"])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,46 @@
+"""
+Module to render the HTML data drift report from a stored data drift profile.
+
+Used to get the report on demand, for drift detection runs that only logged the profile.
+Only profiles from the native drift engine can be rendered.
+"""
+import json
+import logging
+
+import hydra
+
+from src.data.drift import DriftProfile, render_drift_report
+from src.data.feature_drift_detection import log_text_file
+from src.utils.artifact_backends import get_artifact_backend
+from src.utils.artifacts import get_artifact_file_path
+
+logger = logging.getLogger(__name__)
+
+
+@hydra.main(config_path="../../conf", config_name="config")
+def main(config):
+    import wandb
+
+    with wandb.init(
+        project=config["main"]["project_name"],
+        job_type="render_drift_report",
+        group=config["main"]["experiment_name"],
+        mode=config["artifact_backend"]["wandb_mode"],
+    ) as run:
+        backend = get_artifact_backend(config, run)
+
+        logger.info("Load data drift profile.")
+        with open(get_artifact_file_path(backend, **config["artifacts"]["feature_drift_profile"])) as file:
+            data_drift_profile = DriftProfile.from_dict(json.load(file))
+
+        logger.info("Render and log data drift report.")
+        log_text_file(
+            backend,
+            render_drift_report(data_drift_profile),
+            "data_drift_report.html",
+            **config["artifacts"]["feature_drift_report"],
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -6,39 +6,44 @@ import logging
 import hydra
 import pandas as pd
 import pandera as pa
-import wandb
 
+from src.utils.artifact_backends import get_artifact_backend
 from src.utils.artifacts import read_dataframe_artifact
 
 logger = logging.getLogger(__name__)
 
 
-def validate_model_input(df: pd.DataFrame) -> pd.DataFrame:
+def validate_model_input(df: pd.DataFrame, feature_dtype: str = "float64") -> pd.DataFrame:
+    """Validate model input against the schema, with features of the dtype set by the dtype policy."""
     schema_model_input = pa.DataFrameSchema({
-        "MedInc": pa.Column(float, nullable=False, required=True),
-        "HouseAge": pa.Column(float, nullable=False, required=True),
-        "AveRooms": pa.Column(float, nullable=False, required=True),
-        "Population": pa.Column(float, nullable=False, required=True),
-        "AveOccup": pa.Column(float, nullable=False, required=True),
-        "Latitude": pa.Column(float, nullable=False, required=True),
-        "Longitude": pa.Column(float, nullable=False, required=True),
+        "MedInc": pa.Column(feature_dtype, nullable=False, required=True),
+        "HouseAge": pa.Column(feature_dtype, nullable=False, required=True),
+        "AveRooms": pa.Column(feature_dtype, nullable=False, required=True),
+        "Population": pa.Column(feature_dtype, nullable=False, required=True),
+        "AveOccup": pa.Column(feature_dtype, nullable=False, required=True),
+        "Latitude": pa.Column(feature_dtype, nullable=False, required=True),
+        "Longitude": pa.Column(feature_dtype, nullable=False, required=True),
     })
     return schema_model_input.validate(df)
 
 
 @hydra.main(config_path="../../conf", config_name="config")
 def main(config):
+    import wandb
+
     with wandb.init(
         project=config["main"]["project_name"],
         job_type="validate-data",
-        group=config["main"]["experiment_name"]
+        group=config["main"]["experiment_name"],
+        mode=config["artifact_backend"]["wandb_mode"],
     ) as run:
+        backend = get_artifact_backend(config, run)
 
         logger.info('Read model input data.')
-        df = read_dataframe_artifact(run, **config["artifacts"]["model_input"])
+        df = read_dataframe_artifact(backend, **config["artifacts"]["model_input"])
 
         logger.info('Validate model input.')
-        df = validate_model_input(df)
+        df = validate_model_input(df, feature_dtype=config["dtypes"]["features"])
 
 
 if __name__ == "__main__":
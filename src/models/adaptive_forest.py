@@ -0,0 +1,83 @@
+"""
+Module for choosing the number of trees of a random forest from the data.
+
+The forest is grown in increments of trees with `warm_start`, and the out-of-bag error is tracked
+after every increment. Growing stops once the relative improvement of the out-of-bag MSE falls
+below a tolerance, so the number of trees, and with it the training time, artifact size and
+inference latency, match what the data needs.
+
+The out-of-bag predictions are accumulated tree by tree, so every increment only predicts with the
+trees it adds, instead of sklearn's `oob_score` recomputing them for the whole forest on every fit.
+"""
+from typing import List, Tuple
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def grow_forest(
+    pipeline,
+    X,
+    y,
+    increment: int = 25,
+    max_n_estimators: int = 500,
+    tol: float = 0.005,
+) -> Tuple[int, List[Tuple[int, float]]]:
+    """Fit the pipeline, growing its forest regressor until the out-of-bag MSE converges.
+
+    The pipeline is fitted in place on all of `X`. After fitting, warm starting is switched off again,
+    so clones of the pipeline fit a forest of the chosen size from scratch.
+    :pipeline: Pipeline with a bootstrapped forest regressor step named `regressor`.
+    :increment: Number of trees added per step.
+    :max_n_estimators: Maximum number of trees.
+    :tol: Growing stops when an increment improves the out-of-bag MSE by less than this fraction.
+    :return: The chosen number of trees, and the number of trees and out-of-bag MSE after every increment.
+    """
+    regressor = pipeline["regressor"]
+    if not {"warm_start", "oob_score", "bootstrap"} <= set(regressor.get_params()):
+        raise ValueError(f"Adaptive tree count needs a forest regressor, got {type(regressor).__name__}.")
+    if not regressor.bootstrap:
+        raise ValueError("Adaptive tree count needs bootstrap=True to compute out-of-bag errors.")
+
+    y = np.asarray(y, dtype=np.float64)
+    pipeline.set_params(regressor__warm_start=True, regressor__oob_score=False)
+    oob_sum = np.zeros(len(y), dtype=np.float64)
+    oob_count = np.zeros(len(y), dtype=np.int64)
+    oob_mse_history = []
+    n_estimators = 0
+    while n_estimators < max_n_estimators:
+        n_previous = n_estimators
+        n_estimators = min(n_estimators + increment, max_n_estimators)
+        pipeline.set_params(regressor__n_estimators=n_estimators)
+        pipeline.fit(X, y)
+
+        X_transformed = X
+        for _, step in pipeline.steps[:-1]:
+            if step != "passthrough":
+                X_transformed = step.transform(X_transformed)
+        # The trees are fitted on float32 input.
+        X_transformed = np.asarray(X_transformed, dtype=np.float32)
+        # The in-bag rows of the trees are drawn again from their seeds on every access, which is cheap
+        # next to predicting, so only the new trees predict.
+        new_trees = zip(regressor.estimators_[n_previous:], regressor.estimators_samples_[n_previous:])
+        for tree, in_bag_rows in new_trees:
+            oob_rows = np.ones(len(y), dtype=bool)
+            oob_rows[in_bag_rows] = False
+            oob_sum[oob_rows] += tree.predict(X_transformed[oob_rows], check_input=False)
+            oob_count[oob_rows] += 1
+        has_oob = oob_count > 0
+        oob_mse = float(np.mean((y[has_oob] - oob_sum[has_oob] / oob_count[has_oob]) ** 2))
+        logger.info(f"Out-of-bag MSE with {n_estimators} trees: {oob_mse:.5f}")
+        previous_oob_mse = oob_mse_history[-1][1] if oob_mse_history else None
+        oob_mse_history.append((n_estimators, oob_mse))
+        if previous_oob_mse is not None and previous_oob_mse - oob_mse < tol * previous_oob_mse:
+            break
+
+    pipeline.set_params(regressor__warm_start=False)
+    # Do not keep out-of-bag results of earlier fits in the logged model.
+    for attribute in ("oob_prediction_", "oob_score_"):
+        if hasattr(regressor, attribute):
+            delattr(regressor, attribute)
+    return n_estimators, oob_mse_history
@@ -0,0 +1,35 @@
+"""
+Module with an averaging ensemble of fitted model pipelines.
+
+Used to keep the models fitted on the cross validation folds as the final model, instead of
+refitting a model on all data.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+
+import numpy as np
+
+
+class AveragingEnsemble:
+    """Ensemble predicting the mean of the predictions of its member pipelines.
+
+    The members predict in parallel threads. The members share their column selector, so the steps of
+    the first member, e.g. ensemble["column_selector"], stand in for the steps of the ensemble.
+    :members: Fitted model pipelines.
+    """
+
+    def __init__(self, members: List):
+        if not members:
+            raise ValueError("An ensemble needs at least one member.")
+        self.members = members
+
+    def __getitem__(self, step_name: str):
+        return self.members[0][step_name]
+
+    def predict_members(self, predict: Callable[..., np.ndarray]) -> np.ndarray:
+        """Mean of `predict(member)` over the members, computed in parallel threads."""
+        with ThreadPoolExecutor(max_workers=len(self.members)) as executor:
+            return np.mean(list(executor.map(predict, self.members)), axis=0)
+
+    def predict(self, X) -> np.ndarray:
+        return self.predict_members(lambda member: member.predict(X))
@@ -3,14 +3,10 @@ The main function is evaluate, which returns metrics and plots about out of samp
 """
 import json
 from pathlib import Path
+from typing import Dict, Optional
 
 import numpy as np
-import matplotlib.pyplot as plt
-from sklearn.metrics import (
-    mean_squared_error,
-    mean_absolute_error,
-    mean_absolute_percentage_error,
-)
+import pandas as pd
 
 
 class RegressionEvaluation:
@@ -28,6 +24,12 @@ class RegressionEvaluation:
         self.y_pred = y_pred
 
     def get_metrics(self) -> dict:
+        from sklearn.metrics import (
+            mean_squared_error,
+            mean_absolute_error,
+            mean_absolute_percentage_error,
+        )
+
         return {
             "mse": mean_squared_error(self.y_true, self.y_pred),
             "mape": mean_absolute_percentage_error(self.y_true, self.y_pred),
@@ -41,6 +43,8 @@ class RegressionEvaluation:
         :log_scale: Whether to use a log scale for the axis
         :return: None
         """
+        import matplotlib.pyplot as plt
+
         fig, ax = plt.subplots()
         plt.scatter(self.y_true, self.y_pred, c='crimson')
         if log_scale:
@@ -60,3 +64,159 @@ class RegressionEvaluation:
         self.plot_actual_vs_predictions(out_dir / Path("actual_vs_predictions_plot.png"))
         with open(out_dir / Path("metrics.json"), "w") as f:
             json.dump(self.get_metrics(), f)
+
+
+class StreamingRegressionEvaluation:
+    """Regression evaluation computed batch by batch, for data that does not fit in memory.
+
+    The metrics are exact. The actual vs. predictions plot is made from a random sample of
+    about `max_plot_points` rows.
+    """
+
+    def __init__(self, n_rows: int, max_plot_points: int = 10000, seed: int = 33) -> None:
+        self.n_rows = 0
+        self.sum_squared_error = 0.0
+        self.sum_absolute_error = 0.0
+        self.sum_absolute_percentage_error = 0.0
+        self._sample_fraction = min(1.0, max_plot_points / max(n_rows, 1))
+        self._rng = np.random.default_rng(seed)
+        self._y_true_sample = []
+        self._y_pred_sample = []
+
+    def update(self, y_true: np.ndarray, y_pred: np.ndarray) -> None:
+        """Add a batch of targets and predictions."""
+        if len(y_true) != len(y_pred):
+            raise ValueError("Length of y_true and y_pred must be the same.")
+        y_true = np.asarray(y_true, dtype=np.float64)
+        y_pred = np.asarray(y_pred, dtype=np.float64)
+        errors = y_true - y_pred
+        self.n_rows += len(y_true)
+        self.sum_squared_error += float(np.dot(errors, errors))
+        self.sum_absolute_error += float(np.abs(errors).sum())
+        # Same definition as sklearn.metrics.mean_absolute_percentage_error.
+        self.sum_absolute_percentage_error += float(
+            (np.abs(errors) / np.maximum(np.abs(y_true), np.finfo(np.float64).eps)).sum()
+        )
+        in_sample = self._rng.random(len(y_true)) < self._sample_fraction
+        self._y_true_sample.append(y_true[in_sample])
+        self._y_pred_sample.append(y_pred[in_sample])
+
+    def get_metrics(self) -> dict:
+        if self.n_rows == 0:
+            raise ValueError("No predictions have been added to the evaluation.")
+        return {
+            "mse": self.sum_squared_error / self.n_rows,
+            "mape": self.sum_absolute_percentage_error / self.n_rows,
+            "mae": self.sum_absolute_error / self.n_rows,
+        }
+
+    def plot_actual_vs_predictions(self, outpath: Path, log_scale=False) -> None:
+        """Plot actual values vs. predictions for the sampled rows. The plot is saved to outpath."""
+        RegressionEvaluation(
+            y_true=np.concatenate(self._y_true_sample),
+            y_pred=np.concatenate(self._y_pred_sample),
+        ).plot_actual_vs_predictions(outpath, log_scale=log_scale)
+
+    def save_evaluation_artifacts(self, out_dir: Path) -> None:
+        """Save all evaluation artifacts to a folder"""
+        self.plot_actual_vs_predictions(out_dir / Path("actual_vs_predictions_plot.png"))
+        with open(out_dir / Path("metrics.json"), "w") as f:
+            json.dump(self.get_metrics(), f)
+
+
+def get_segments(df: pd.DataFrame, slice_definitions: dict) -> Dict[str, pd.Categorical]:
+    """Assign every row of a dataframe to a segment, for every slicing of the data.
+
+    :slice_definitions: Dictionary from slicing name to its definition, one of
+        - {column: HouseAge, bins: [0, 10, 20]}: Bands with the given edges, closed on the left.
+        - {column: MedInc, quantiles: 10}: Quantile bins of the column, e.g. deciles.
+        - {columns: [Latitude, Longitude], cell_size: 1.0}: Cells of a grid over the columns.
+    :return: Dictionary from slicing name to the segment of every row. Rows outside all segments, or with
+        missing values in the sliced columns, are NaN.
+    """
+    segments = {}
+    for name, definition in slice_definitions.items():
+        if "bins" in definition:
+            segments[name] = pd.Categorical(pd.cut(df[definition["column"]], bins=list(definition["bins"]), right=False))
+        elif "quantiles" in definition:
+            segments[name] = pd.Categorical(
+                pd.qcut(df[definition["column"]], q=definition["quantiles"], duplicates="drop")
+            )
+        elif "cell_size" in definition:
+            values = df[list(definition["columns"])].to_numpy(dtype=np.float64)
+            in_grid = ~np.isnan(values).any(axis=1)
+            cells = np.floor(values[in_grid] / definition["cell_size"]).astype(np.int64)
+            cell_codes, unique_cells = pd.factorize(pd.MultiIndex.from_arrays(cells.T), sort=True)
+            codes = np.full(len(df), -1, dtype=np.int64)
+            codes[in_grid] = cell_codes
+            labels = [
+                ",".join(f"{cell * definition['cell_size']:g}" for cell in unique_cell) for unique_cell in unique_cells
+            ]
+            segments[name] = pd.Categorical.from_codes(codes, categories=labels)
+        else:
+            raise ValueError(f"Slice {name} needs bins, quantiles or cell_size. Got {dict(definition)}.")
+    return segments
+
+
+class SlicedRegressionEvaluation:
+    """Regression metrics for every segment of one or more slicings of the data.
+
+    The errors of all rows are grouped by the segments of all slicings at once, so the metrics of
+    every segment are computed in a single vectorized pass, instead of one pass per segment.
+    """
+
+    def __init__(self, y_true: np.ndarray, y_pred: np.ndarray, segments: Dict[str, pd.Categorical]) -> None:
+        """Construct the Evaluation object
+        :y_true: Ground truth (correct) target values.
+        :y_pred: Predictions from the regressor.
+        :segments: Dictionary from slicing name to the segment of every row, see `get_segments`.
+        :return: None
+        """
+        if len(y_true) != len(y_pred):
+            raise ValueError("Length of y_true and y_pred must be the same.")
+        self.y_true = np.asarray(y_true, dtype=np.float64)
+        self.y_pred = np.asarray(y_pred, dtype=np.float64)
+        self.segments = segments
+        self._metrics: Optional[pd.DataFrame] = None
+
+    def get_metrics(self) -> pd.DataFrame:
+        """Get a table with a row per segment and the columns slicing, segment, n_rows, mse, mape and mae."""
+        if self._metrics is not None:
+            return self._metrics
+
+        errors = self.y_true - self.y_pred
+        absolute_errors = np.abs(errors)
+        # Same definition as sklearn.metrics.mean_absolute_percentage_error.
+        absolute_percentage_errors = absolute_errors / np.maximum(np.abs(self.y_true), np.finfo(np.float64).eps)
+
+        # Give the segments of all slicings a global id, and group all rows of all slicings at once.
+        # The codes are cast to int64, as pandas stores them in the smallest integer type that fits the
+        # categories of a single slicing, which overflows when adding the offset of the slicing.
+        group_ids, slicing_names, segment_labels = [], [], []
+        for name, segment in self.segments.items():
+            if len(segment) != len(self.y_true):
+                raise ValueError(f"Slicing {name} has {len(segment)} rows, expected {len(self.y_true)}.")
+            codes = np.asarray(segment.codes, dtype=np.int64)
+            group_ids.append(np.where(codes >= 0, codes + len(segment_labels), -1))
+            slicing_names += [name] * len(segment.categories)
+            segment_labels += [str(category) for category in segment.categories]
+        group_ids = np.concatenate(group_ids)
+        in_segment = group_ids >= 0
+        group_ids = group_ids[in_segment]
+        n_slicings = len(self.segments)
+
+        def grouped_sum(values: Optional[np.ndarray] = None) -> np.ndarray:
+            weights = None if values is None else np.tile(values, n_slicings)[in_segment]
+            return np.bincount(group_ids, weights=weights, minlength=len(segment_labels))
+
+        n_rows = grouped_sum()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self._metrics = pd.DataFrame({
+                "slicing": slicing_names,
+                "segment": segment_labels,
+                "n_rows": n_rows.astype(np.int64),
+                "mse": grouped_sum(errors ** 2) / n_rows,
+                "mape": grouped_sum(absolute_percentage_errors) / n_rows,
+                "mae": grouped_sum(absolute_errors) / n_rows,
+            })
+        return self._metrics
@@ -1,47 +1,220 @@
-"""Module to do batch inference."""
+"""Module to do batch inference.
+
+Besides the model configured in `artifacts.model`, any number of shadow models can be configured in
+`main.shadow_model_versions`, e.g. [latest] to score the newest challenger on live data.
+All models are loaded concurrently and scored on the same feature matrix, chunk by chunk,
+and the predictions of every shadow model are written as an extra column of the predictions artifact.
+The feature matrix is read straight from the parquet file of the model input. Other columns of the
+model input are only read when they are needed, for the row keys or the predictions artifact.
+
+Where predictions are written is set with `main.predictions_sink`:
+- store: Append the row keys, predictions and model features to the predictions store in
+  `main.predictions_store_dir`. See src.utils.predictions_store.
+- artifact: Log the model input with the predictions as a new version of the predictions artifact.
+- both: Both of the above.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
 import logging
+import uuid
 
 import hydra
-import wandb
+import numpy as np
+import pandas as pd
 
-from src.utils.artifacts import read_dataframe_artifact, log_dataframe
-from src.utils.models import get_model
+from src.models.prediction_cache import PredictionCache
+from src.utils.artifact_backends import ArtifactBackend, get_artifact_backend
+from src.utils.artifacts import get_dataframe_artifact_source, log_dataframe
+from src.utils.feature_matrix import dataframe_to_feature_matrix, read_feature_matrix
+from src.utils.predictions_store import PredictionsStore, get_row_keys
 
 logger = logging.getLogger(__name__)
 
 
+def load_models(backend: ArtifactBackend, model_name: str, model_versions: List[str]) -> list:
+    """Load several versions of a model concurrently. Versions can be aliases, like prod."""
+    from src.utils.models import get_model
+
+    with ThreadPoolExecutor(max_workers=len(model_versions)) as executor:
+        return list(executor.map(lambda version: get_model(backend, model_name, version), model_versions))
+
+
+def get_feature_columns(loaded_models: list) -> List[str]:
+    """Get the union of the feature columns of several models, in the order they are first used."""
+    return list(dict.fromkeys(
+        column for loaded_model in loaded_models for column in loaded_model.feature_columns
+    ))
+
+
+def score_models(
+    matrix: np.ndarray,
+    feature_columns: List[str],
+    loaded_models: list,
+    prediction_caches: Optional[List[Optional[PredictionCache]]] = None,
+    chunk_size: Optional[int] = None,
+) -> Dict[str, dict]:
+    """Score several models on the same data in a single pass.
+
+    The feature matrix is fed straight to the fitted estimators. Every chunk of rows is scored by all
+    models before moving on to the next chunk.
+    :matrix: C ordered feature matrix, see src.utils.feature_matrix.
+    :feature_columns: Columns of the matrix. Must include the feature columns of all models.
+    :return: Dictionary from model version to its predictions and prediction cache hit rate.
+    """
+    prediction_caches = prediction_caches or [None] * len(loaded_models)
+    n_rows = len(matrix)
+    chunk_size = chunk_size or max(n_rows, 1)
+
+    # Models using all feature columns in the same order share the matrix, others get their own copy.
+    model_matrices = {}
+    for loaded_model in loaded_models:
+        positions = [feature_columns.index(column) for column in loaded_model.feature_columns]
+        model_matrices[loaded_model.model_meta_data.version] = (
+            matrix if positions == list(range(len(feature_columns))) else np.ascontiguousarray(matrix[:, positions])
+        )
+
+    predictions = {
+        loaded_model.model_meta_data.version: np.empty(n_rows, dtype=np.float64)
+        for loaded_model in loaded_models
+    }
+    cache_hits = {loaded_model.model_meta_data.version: 0.0 for loaded_model in loaded_models}
+    for start in range(0, n_rows, chunk_size):
+        stop = min(start + chunk_size, n_rows)
+        # The prediction cache hashes the rows of a dataframe, viewing the chunk of the matrix.
+        chunk = None
+        for loaded_model, prediction_cache in zip(loaded_models, prediction_caches):
+            version = loaded_model.model_meta_data.version
+            if prediction_cache is None:
+                predictions[version][start:stop] = loaded_model.predict_matrix(model_matrices[version][start:stop])
+            else:
+                if chunk is None:
+                    chunk = pd.DataFrame(matrix[start:stop], columns=feature_columns, copy=False)
+                chunk_predictions, hit_rate = prediction_cache.predict(
+                    lambda rows: loaded_model.predict_matrix(
+                        dataframe_to_feature_matrix(rows, loaded_model.feature_columns)
+                    ),
+                    chunk,
+                    loaded_model.feature_columns,
+                )
+                predictions[version][start:stop] = chunk_predictions
+                cache_hits[version] += hit_rate * (stop - start)
+
+    return {
+        version: {
+            "predictions": version_predictions,
+            "cache_hit_rate": cache_hits[version] / n_rows if n_rows else 0.0,
+        }
+        for version, version_predictions in predictions.items()
+    }
+
+
 @hydra.main(config_path="../../conf", config_name="config")
 def main(config):
+    import wandb
+
     run = wandb.init(
         project=config["main"]["project_name"],
         job_type="batch_inference",
         group=config["main"]["experiment_name"],
+        mode=config["artifact_backend"]["wandb_mode"],
     )
+    backend = get_artifact_backend(config, run)
 
-    logger.info("Load model.")
-    loaded_model = get_model(
-        config["main"]["project_name"],
+    model_aliases = [config['artifacts']['model']['version']] + list(
+        config["main"].get("shadow_model_versions", None) or []
+    )
+    logger.info(f"Load models {model_aliases}.")
+    loaded_models = load_models(
+        backend,
         config['artifacts']['model']["name"],
-        config['artifacts']['model']['version']
+        model_aliases,
     )
-    run.use_artifact(loaded_model.wandb_artifact)
+
+    # Aliases can point to the same model version, which only needs to be scored once.
+    unique_models = {}
+    for alias, loaded_model in zip(model_aliases, loaded_models):
+        unique_models.setdefault(loaded_model.model_meta_data.version, (alias, loaded_model))
+    for _, loaded_model in unique_models.values():
+        backend.use_artifact(loaded_model.artifact.name, loaded_model.artifact.version)
+    loaded_model = loaded_models[0]
+
+    predictions_sink = config["main"].get("predictions_sink", "store")
+    if predictions_sink not in ("store", "artifact", "both"):
+        raise ValueError(f"Unknown predictions_sink {predictions_sink}. Use store, artifact or both.")
 
     logger.info("Get model input.")
-    df = read_dataframe_artifact(run, **config['artifacts']['model_input'])
+    model_input = get_dataframe_artifact_source(backend, **config['artifacts']['model_input'])
+    feature_columns = get_feature_columns([model for _, model in unique_models.values()])
+    matrix = read_feature_matrix(model_input.file_path, feature_columns)
+    # The predictions artifact holds the full model input, the predictions store only needs the row keys.
+    row_key_columns = config["main"].get("row_key_columns", None)
+    df = pd.read_parquet(
+        model_input.file_path,
+        columns=None if predictions_sink in ("artifact", "both") else list(row_key_columns or []),
+    )
+    if model_input.bitmap is not None:
+        rows = np.unpackbits(model_input.bitmap, count=len(matrix)).astype(bool)
+        matrix = matrix[rows]
+        df = df[rows].copy()
+
+    cache_dir = config["main"].get("prediction_cache_dir", None)
+    prediction_caches = [
+        PredictionCache(
+            cache_dir=cache_dir,
+            model_name=config['artifacts']['model']["name"],
+            model_version=version,
+            alias=alias,
+        ) if cache_dir else None
+        for version, (alias, _) in unique_models.items()
+    ]
 
     logger.info("Predict.")
-    df['prediction'] = loaded_model.model.predict(df)
+    scores = score_models(
+        matrix,
+        feature_columns,
+        [model for _, model in unique_models.values()],
+        prediction_caches=prediction_caches,
+        chunk_size=config["main"].get("inference_chunk_size", None),
+    )
+    df['prediction'] = scores[loaded_model.model_meta_data.version]["predictions"]
     df['model_version'] = loaded_model.model_meta_data.version
-
-    logger.info("Log predictions.")
-    log_dataframe(run=run, df=df, **config['artifacts']['predictions'])
+    for version, version_scores in scores.items():
+        if version != loaded_model.model_meta_data.version:
+            df[f'prediction_{version}'] = version_scores["predictions"]
+
+    if cache_dir:
+        hit_rate = scores[loaded_model.model_meta_data.version]["cache_hit_rate"]
+        logger.info(f"Prediction cache hit rate: {hit_rate:.2%}")
+        run.log({
+            "prediction_cache_hit_rate": hit_rate,
+            **{
+                f"prediction_cache_hit_rate_{version}": version_scores["cache_hit_rate"]
+                for version, version_scores in scores.items()
+            },
+        })
+
+    if predictions_sink in ("store", "both"):
+        from hydra.utils import to_absolute_path
+
+        logger.info("Append predictions to predictions store.")
+        store = PredictionsStore(to_absolute_path(config["main"]["predictions_store_dir"]))
+        row_keys = get_row_keys(df, row_key_columns)
+        batch_id = getattr(run, "id", None) or uuid.uuid4().hex
+        store.append_predictions(
+            row_keys,
+            predictions={version: version_scores["predictions"] for version, version_scores in scores.items()},
+            production_version=loaded_model.model_meta_data.version,
+            batch_id=batch_id,
+        )
+        store.append_features(
+            row_keys, pd.DataFrame(matrix, columns=feature_columns, copy=False), batch_id=batch_id
+        )
+        run.log({"n_predictions": len(df)})
+
+    if predictions_sink in ("artifact", "both"):
+        logger.info("Log predictions.")
+        log_dataframe(backend=backend, df=df, **config['artifacts']['predictions'])
 
 
 if __name__ == '__main__':
     main()
-
-
-
-
-
-
@@ -8,11 +8,7 @@ from pathlib import Path
 from copy import deepcopy
 
 from sklearn.pipeline import Pipeline
-from sklearn.linear_model import Ridge
-from sklearn.ensemble import RandomForestRegressor
 import pandas as pd
-import seaborn as sns
-from matplotlib import pyplot as plt
 
 from src.models.custom_transfomer_classes import ColumnSelector
 
@@ -52,6 +48,8 @@ class RidgePipelineConfig(BasePipelineConfig):
         input:
             params: Parameters for the sklearn compatible pipeline.
         """
+        from sklearn.linear_model import Ridge
+
         features = [
             'MedInc',
             'HouseAge',
@@ -79,11 +77,11 @@ class RidgePipelineConfig(BasePipelineConfig):
             "channels": ["defaults"],
             "dependencies": [
                 "python=3.9",
-                "scikit-learn==1.0.2",
+                "scikit-learn==1.4.2",
                 "pip",
                 {
                     "pip": [
-                        "mlflow==1.23.1",
+                        "mlflow==2.9.2",
                     ],
                 },
             ],
@@ -106,6 +104,8 @@ class RandomForestPipelineConfig(BasePipelineConfig):
         input:
             params: Parameters for the sklearn compatible pipeline.
         """
+        from sklearn.ensemble import RandomForestRegressor
+
         features = [
             'MedInc',
             'HouseAge',
@@ -133,11 +133,11 @@ class RandomForestPipelineConfig(BasePipelineConfig):
             "channels": ["defaults"],
             "dependencies": [
                 "python=3.9",
-                "scikit-learn1.0.2",
+                "scikit-learn==1.4.2",
                 "pip",
                 {
                     "pip": [
-                        "mlflow==1.23.1",
+                        "mlflow==2.9.2",
                     ],
                 },
             ],
@@ -147,6 +147,9 @@ class RandomForestPipelineConfig(BasePipelineConfig):
     @staticmethod
     def save_fitted_pipeline_plots(pipeline, out_dir: str):
         """Save plot of feature importances for random forest model."""
+        import seaborn as sns
+        from matplotlib import pyplot as plt
+
         rf_features = pipeline["regressor"].feature_names_in_
         rf_feature_importances = pipeline["regressor"].feature_importances_
         feature_importance_df = pd.DataFrame(
@@ -167,3 +170,81 @@ class RandomForestPipelineConfig(BasePipelineConfig):
         fig = ax.get_figure()
         fig.subplots_adjust(bottom=0.3)
         fig.savefig(Path(out_dir) / Path("random_forest_feature_importances.png"))
+
+
+class HistGradientBoostingPipelineConfig(BasePipelineConfig):
+    """Model config for ML pipeline using a histogram based gradient boosting model.
+
+    The booster bins the features itself, into at most `regressor__max_bins` quantile bins.
+    """
+
+    @staticmethod
+    def get_pipeline(**params):
+        """Get histogram gradient boosting pipeline
+        The pipeline works on a dataframe and selects the features.
+        The booster stops early when the loss on an internal validation set stops improving.
+        input:
+            params: Parameters for the sklearn compatible pipeline.
+        """
+        from sklearn.ensemble import HistGradientBoostingRegressor
+
+        features = [
+            'MedInc',
+            'HouseAge',
+            'AveRooms',
+            'AveBedrms',
+            'Population',
+            'AveOccup',
+            'Latitude',
+            'Longitude',
+            'avg_bedrooms_per_room',
+        ]
+
+        # Define pipeline
+        vanilla_pipeline = Pipeline([
+            ("column_selector", ColumnSelector(features)),
+            ("regressor", HistGradientBoostingRegressor(
+                max_iter=1000,
+                max_bins=255,
+                early_stopping=True,
+                validation_fraction=0.1,
+                n_iter_no_change=20,
+                random_state=33,
+            ))
+        ])
+        return deepcopy(vanilla_pipeline).set_params(**params)
+
+    @staticmethod
+    def get_conda_env() -> dict:
+        """Get conda environment spec"""
+        return {
+            "channels": ["defaults"],
+            "dependencies": [
+                "python=3.9",
+                "scikit-learn==1.4.2",
+                "pip",
+                {
+                    "pip": [
+                        "mlflow==2.9.2",
+                    ],
+                },
+            ],
+            "name": "hist-gradient-boosting-model-env",
+        }
+
+    @staticmethod
+    def save_fitted_pipeline_plots(pipeline, out_dir: str):
+        """Save plot of the training and validation loss per boosting iteration."""
+        from matplotlib import pyplot as plt
+
+        regressor = pipeline["regressor"]
+        fig, ax = plt.subplots(figsize=(10, 6))
+        ax.plot(-regressor.train_score_, label="train")
+        if len(regressor.validation_score_):
+            ax.plot(-regressor.validation_score_, label="validation")
+        ax.set_xlabel("iteration")
+        ax.set_ylabel("loss")
+        ax.set_title(f"Stopped after {regressor.n_iter_} iterations")
+        ax.legend()
+        fig.savefig(Path(out_dir) / Path("hist_gradient_boosting_loss.png"))
+        plt.close(fig)
@@ -0,0 +1,138 @@
+"""
+Module with a local cache of batch predictions.
+
+Predictions are keyed by model version and a hash of the feature vector the model pipeline selects,
+so rows that were already scored by the same model version are not predicted again.
+Every model version has its own directory of parquet files holding the row hashes and predictions.
+The cache of a model version is removed when the alias it was loaded through moves to another version.
+Every batch of new predictions is appended as a new part, and the parts are compacted into one
+when there are more than `max_parts`, so reading the cache does not degrade over time.
+"""
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+import json
+import logging
+import shutil
+import uuid
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+def hash_rows(df: pd.DataFrame, columns: List[str]) -> np.ndarray:
+    """Get a 64 bit hash of the values in `columns` for every row."""
+    return pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+
+
+class PredictionCache:
+    """Cache of the predictions of a single model version.
+
+    :cache_dir: Root directory of the cache.
+    :model_name: Name of the model.
+    :model_version: Version of the model, e.g. v3.
+    :alias: Alias the model version was loaded through, e.g. prod.
+        Caches of versions the alias pointed to earlier are removed.
+    :max_parts: Maximum number of parquet parts before they are compacted into one.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        model_name: str,
+        model_version: str,
+        alias: Optional[str] = None,
+        max_parts: int = 16,
+    ):
+        self.model_dir = Path(cache_dir) / model_name
+        self.version_dir = self.model_dir / model_version
+        self.version_dir.mkdir(parents=True, exist_ok=True)
+        self.max_parts = max_parts
+        self._cached: Optional[pd.DataFrame] = None
+        # Parts whose rows are in `_cached`. Only these are removed when compacting, so parts
+        # appended by other processes in the meantime are kept.
+        self._parts: List[Path] = []
+        if alias is not None and alias != model_version:
+            self._update_alias(alias, model_version)
+
+    def _update_alias(self, alias: str, model_version: str) -> None:
+        aliases_path = self.model_dir / "aliases.json"
+        aliases = json.loads(aliases_path.read_text()) if aliases_path.exists() else {}
+        previous_version = aliases.get(alias)
+        aliases[alias] = model_version
+
+        tmp_path = aliases_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(aliases))
+        tmp_path.replace(aliases_path)
+
+        if previous_version not in (None, model_version) and previous_version not in aliases.values():
+            logger.info(f"Alias {alias} moved from {previous_version} to {model_version}. Invalidating cache.")
+            shutil.rmtree(self.model_dir / previous_version, ignore_errors=True)
+
+    def _read(self) -> pd.DataFrame:
+        """Read the cached predictions once, later calls use the in memory copy."""
+        if self._cached is None:
+            parts = sorted(self.version_dir.glob("*.parquet"))
+            self._parts = parts
+            if parts:
+                cached = pd.concat([pd.read_parquet(part) for part in parts], ignore_index=True)
+            else:
+                cached = pd.DataFrame({"row_hash": np.array([], dtype=np.uint64), "prediction": np.array([])})
+            self._cached = cached.drop_duplicates("row_hash")
+        return self._cached
+
+    def _write_part(self, df: pd.DataFrame) -> Path:
+        part_name = uuid.uuid4().hex
+        tmp_path = self.version_dir / f"{part_name}.tmp"
+        df.to_parquet(tmp_path, index=False)
+        part_path = self.version_dir / f"{part_name}.parquet"
+        tmp_path.replace(part_path)
+        return part_path
+
+    def _append(self, row_hashes: np.ndarray, predictions: np.ndarray) -> None:
+        new = pd.DataFrame({"row_hash": row_hashes, "prediction": predictions})
+        cached = self._read()
+        self._parts.append(self._write_part(new))
+        self._cached = pd.concat([cached, new], ignore_index=True)
+        if len(self._parts) > self.max_parts:
+            self.compact()
+
+    def compact(self) -> None:
+        """Rewrite the parts read by this cache as a single part."""
+        cached = self._read().drop_duplicates("row_hash", ignore_index=True)
+        compacted_part = self._write_part(cached)
+        for part in self._parts:
+            part.unlink(missing_ok=True)
+        logger.info(f"Compacted {len(self._parts)} prediction cache parts of {self.version_dir.name}.")
+        self._parts = [compacted_part]
+        self._cached = cached
+
+    def predict(
+        self,
+        predict: Callable[[pd.DataFrame], np.ndarray],
+        df: pd.DataFrame,
+        feature_columns: List[str],
+    ) -> Tuple[np.ndarray, float]:
+        """Get predictions for all rows of `df`, only calling `predict` on the rows not in the cache.
+
+        :predict: Prediction function of the model version the cache belongs to.
+        :df: Model input.
+        :feature_columns: Columns the model uses. Rows with the same values in them share predictions.
+        :return: Predictions and the share of rows that were found in the cache.
+        """
+        row_hashes = hash_rows(df, feature_columns)
+        cached = self._read()
+        positions = pd.Index(cached["row_hash"].to_numpy()).get_indexer(row_hashes)
+        hits = positions >= 0
+
+        predictions = np.empty(len(df), dtype=np.float64)
+        predictions[hits] = cached["prediction"].to_numpy()[positions[hits]]
+        if not hits.all():
+            misses = np.flatnonzero(~hits)
+            predictions[misses] = predict(df.iloc[misses])
+            new_hashes, first_occurrence = np.unique(row_hashes[misses], return_index=True)
+            self._append(new_hashes, predictions[misses][first_occurrence])
+
+        hit_rate = float(hits.mean()) if len(df) else 0.0
+        return predictions, hit_rate
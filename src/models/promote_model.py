@@ -2,21 +2,33 @@
 Script for promoting latest trained model to production if the performance on a hold out set:
 - is better than a fixed threshold.
 - is better than the current production model.
+
+The hold out data and both models are fetched concurrently, and the two models predict in parallel.
+
+The metrics of both models are also computed per segment of the slicings in `evaluation.slices`,
+and logged as the `slice_metrics` table. Promotion can be gated on them with
+`main.max_slice_mae_to_promote` and `main.max_slice_mae_regression_to_promote`.
 """
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 import logging
 
 import hydra
-import wandb
+import numpy as np
+import pandas as pd
 
-from src.models.evaluation import RegressionEvaluation
+from src.models.evaluation import RegressionEvaluation, SlicedRegressionEvaluation, get_segments
+from src.utils.artifact_backends import ArtifactBackend, get_artifact_backend
 from src.utils.artifacts import read_dataframe_artifact
-from src.utils.models import get_model
+from src.utils.feature_matrix import dataframe_to_feature_matrix
 from src.exceptions import ArtifactDoesNoteExistError
 
 logger = logging.getLogger(__name__)
 
 
 def log_promotion_status(model_version: str, additional_info: str, model_to_be_promoted: bool) -> None:
+    import wandb
+
     if model_to_be_promoted:
         message = f"Trained model version {model_version} promoted."
         logger.info(
@@ -41,15 +53,49 @@ def log_promotion_status(model_version: str, additional_info: str, model_to_be_p
         )
 
 
+def get_model_if_exists(backend: ArtifactBackend, model_name: str, model_version: str):
+    """Load a model version, or return None if it does not exist."""
+    from src.utils.models import get_model
+
+    try:
+        return get_model(backend=backend, model_name=model_name, model_version=model_version)
+    except ArtifactDoesNoteExistError:
+        return None
+
+
+def predict(loaded_model, df) -> np.ndarray:
+    return loaded_model.predict_matrix(dataframe_to_feature_matrix(df, loaded_model.feature_columns))
+
+
+def format_slices(slice_metrics: pd.DataFrame) -> str:
+    return ", ".join(f"{row.slicing}={row.segment}" for row in slice_metrics.itertuples())
+
+
 class SingleModelTest:
 
-    def __init__(self, model, test_data, target_col, max_mae):
-        self.model = model
+    def __init__(
+        self,
+        predictions,
+        test_data,
+        target_col,
+        max_mae,
+        slice_metrics: Optional[pd.DataFrame] = None,
+        max_slice_mae: Optional[float] = None,
+        min_slice_rows: int = 0,
+    ):
+        """
+        :slice_metrics: Metrics per segment, from SlicedRegressionEvaluation.get_metrics.
+        :max_slice_mae: The MAE of every segment with at least `min_slice_rows` rows must be below this.
+            Not tested if None.
+        """
         self.test_data = test_data
         self.target_col = target_col
         self.max_mae = max_mae
-        self.predictions = model.predict(test_data)
+        self.predictions = predictions
         self.model_mae = self._calc_model_mae(self.predictions, test_data, target_col)
+        self.slice_metrics = slice_metrics
+        self.max_slice_mae = max_slice_mae
+        self.min_slice_rows = min_slice_rows
 
     @staticmethod
     def _calc_model_mae(predictions, test_data, target_col):
@@ -65,10 +111,18 @@ class SingleModelTest:
     def _predictions_all_positive(self) -> bool:
         return self.predictions.min() > 0
 
+    def _slices_with_too_high_mae(self) -> pd.DataFrame:
+        if self.slice_metrics is None or self.max_slice_mae is None:
+            return pd.DataFrame(columns=["slicing", "segment"])
+        return self.slice_metrics[
+            (self.slice_metrics["n_rows"] >= self.min_slice_rows)
+            & (self.slice_metrics["mae"] >= self.max_slice_mae)
+        ]
+
     @property
     def model_passes_tests(self) -> bool:
         return all([
-            self._model_has_ok_mae(), self._predictions_all_positive()
+            self._model_has_ok_mae(), self._predictions_all_positive(), self._slices_with_too_high_mae().empty
         ])
 
     @property
@@ -84,30 +138,63 @@ class SingleModelTest:
         edge_case_message = (
             "The model passes all edge cases" if self._predictions_all_positive() else "The model does not pass all edge cases"
         )
-        return f"{mae_message}. {edge_case_message}."
+        failing_slices = self._slices_with_too_high_mae()
+        slice_message = (
+            f" The MAE is not below {self.max_slice_mae} for the segments {format_slices(failing_slices)}."
+            if not failing_slices.empty else ""
+        )
+        return f"{mae_message}. {edge_case_message}.{slice_message}"
 
 
 class ChallengerModelTest:
-    def __init__(self, model_challenger, model_current, test_data, target_col):
-        self.model_challenger = model_challenger
-        self.model_current = model_current
+    def __init__(
+        self,
+        challenger_predictions,
+        current_predictions,
+        test_data,
+        target_col,
+        challenger_slice_metrics: Optional[pd.DataFrame] = None,
+        current_slice_metrics: Optional[pd.DataFrame] = None,
+        max_slice_mae_regression: Optional[float] = None,
+        min_slice_rows: int = 0,
+    ):
+        """
+        :challenger_slice_metrics: Metrics per segment of the challenger, from SlicedRegressionEvaluation.
+        :current_slice_metrics: Metrics per segment of the current model, for the same segments.
+        :max_slice_mae_regression: The challenger MAE of every segment with at least `min_slice_rows` rows
+            may be at most this fraction higher than the current MAE. Not tested if None.
+        """
         self.test_data = test_data
         self.target_col = target_col
-        self.model_challenger_mae = self._calc_model_mae(model_challenger, test_data, target_col)
-        self.model_current_mae = self._calc_model_mae(model_current, test_data, target_col)
+        self.model_challenger_mae = self._calc_model_mae(challenger_predictions, test_data, target_col)
+        self.model_current_mae = self._calc_model_mae(current_predictions, test_data, target_col)
+        self.challenger_slice_metrics = challenger_slice_metrics
+        self.current_slice_metrics = current_slice_metrics
+        self.max_slice_mae_regression = max_slice_mae_regression
+        self.min_slice_rows = min_slice_rows
 
     @staticmethod
-    def _calc_model_mae(model, test_data, target_col):
-        predictions = model.predict(test_data)
+    def _calc_model_mae(predictions, test_data, target_col):
         evaluation = RegressionEvaluation(
             y_true=test_data[target_col],
             y_pred=predictions
         )
         return evaluation.get_metrics()["mae"]
 
+    def _regressed_slices(self) -> pd.DataFrame:
+        if self.challenger_slice_metrics is None or self.current_slice_metrics is None or self.max_slice_mae_regression is None:
+            return pd.DataFrame(columns=["slicing", "segment"])
+        slices = self.challenger_slice_metrics.merge(
+            self.current_slice_metrics, on=["slicing", "segment", "n_rows"], suffixes=("_challenger", "_current")
+        )
+        return slices[
+            (slices["n_rows"] >= self.min_slice_rows)
+            & (slices["mae_challenger"] > slices["mae_current"] * (1 + self.max_slice_mae_regression))
+        ]
+
     @property
     def challenger_model_is_better(self) -> bool:
-        return self.model_challenger_mae < self.model_current_mae
+        return self.model_challenger_mae < self.model_current_mae and self._regressed_slices().empty
 
     @property
     def message(self):
@@ -121,53 +208,92 @@ class ChallengerModelTest:
                 f"Challenger model has MAE of {self.model_challenger_mae}, "
                 f"which is worse than the current models performance of {self.model_current_mae}"
             )
+        regressed_slices = self._regressed_slices()
+        slice_message = (
+            f" Challenger model MAE is more than {self.max_slice_mae_regression:.0%} worse than the current model "
+            f"for the segments {format_slices(regressed_slices)}."
+            if not regressed_slices.empty else ""
+        )
 
-        return f"{mae_message}."
+        return f"{mae_message}.{slice_message}"
 
 
 @hydra.main(config_path="../../conf", config_name="config")
 def main(config):
+    import wandb
+
     run = wandb.init(
         project=config["main"]["project_name"],
         job_type="test_and_promote_model",
         group=config["main"]["experiment_name"],
+        mode=config["artifact_backend"]["wandb_mode"],
     )
+    backend = get_artifact_backend(config, run)
 
-    logger.info("Load hold out test data.")
-    test_data = read_dataframe_artifact(
-        run=run,
-        name=config['artifacts']['test_data']['name'],
-        version="latest"
-    )
+    logger.info("Load hold out test data, latest trained model and current prod model if it exists.")
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        test_data_future = executor.submit(
+            read_dataframe_artifact,
+            backend=backend,
+            name=config['artifacts']['test_data']['name'],
+            version="latest",
+        )
+        challenger_future = executor.submit(
+            get_model_if_exists, backend, config['artifacts']['model']['name'], "latest"
+        )
+        current_future = executor.submit(
+            get_model_if_exists, backend, config['artifacts']['model']['name'], "prod"
+        )
+        test_data = test_data_future.result()
+        loaded_model_challenger = challenger_future.result()
+        loaded_model_current = current_future.result()
 
-    logger.info("Loading latest trained model.")
-    loaded_model_challenger = get_model(
-        project_name=config["main"]["project_name"],
-        model_name=config['artifacts']['model']['name'],
-        model_version="latest"
-    )
-    if "prod" in loaded_model_challenger.wandb_artifact.aliases:
+    if loaded_model_challenger is None:
+        raise ArtifactDoesNoteExistError("No trained model to promote.")
+    if "prod" in loaded_model_challenger.artifact.aliases:
         raise ValueError(
             'Latest trained model is already the production model. Something is wrong.'
         )
 
-    logger.info("Loading current prod model if it exists.")
-    try:
-        loaded_model_current = get_model(
-            project_name=config["main"]["project_name"],
-            model_name=config['artifacts']['model']['name'],
-            model_version="prod"
+    logger.info("Predict on hold out test data.")
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        challenger_predictions_future = executor.submit(predict, loaded_model_challenger, test_data)
+        current_predictions_future = (
+            executor.submit(predict, loaded_model_current, test_data) if loaded_model_current else None
         )
-    except ArtifactDoesNoteExistError:
-        loaded_model_current = None
+        challenger_predictions = challenger_predictions_future.result()
+        current_predictions: Optional[np.ndarray] = (
+            current_predictions_future.result() if current_predictions_future else None
+        )
+
+    target_col = config["main"]["target_column"]
+    min_slice_rows = config["main"].get("min_slice_rows_to_test", 0)
+    challenger_slice_metrics = current_slice_metrics = None
+    slice_definitions = config["evaluation"].get("slices", None)
+    if slice_definitions:
+        logger.info("Evaluate models per segment.")
+        segments = get_segments(test_data, slice_definitions)
+        challenger_slice_metrics = SlicedRegressionEvaluation(
+            test_data[target_col], challenger_predictions, segments
+        ).get_metrics()
+        slice_metrics = [challenger_slice_metrics.assign(model="challenger")]
+        if current_predictions is not None:
+            current_slice_metrics = SlicedRegressionEvaluation(
+                test_data[target_col], current_predictions, segments
+            ).get_metrics()
+            slice_metrics.append(current_slice_metrics.assign(model="current"))
+        run.log({"slice_metrics": wandb.Table(dataframe=pd.concat(slice_metrics, ignore_index=True))})
 
     logger.info("Running single model tests.")
-    run.use_artifact(loaded_model_challenger.wandb_artifact)
+    backend.use_artifact(loaded_model_challenger.artifact.name, loaded_model_challenger.artifact.version)
     single_model_test = SingleModelTest(
-        model=loaded_model_challenger.model,
+        predictions=challenger_predictions,
         test_data=test_data,
-        target_col=config["main"]["target_column"],
-        max_mae=config["main"]["max_mae_to_promote"]
+        target_col=target_col,
+        max_mae=config["main"]["max_mae_to_promote"],
+        slice_metrics=challenger_slice_metrics,
+        max_slice_mae=config["main"].get("max_slice_mae_to_promote", None),
+        min_slice_rows=min_slice_rows,
     )
 
     if not loaded_model_current:
@@ -184,12 +310,16 @@ def main(config):
         )
     else:
         logger.info("Running model challenger comparison tests.")
-        run.use_artifact(loaded_model_current.wandb_artifact)
+        backend.use_artifact(loaded_model_current.artifact.name, loaded_model_current.artifact.version)
         challenger_model_test = ChallengerModelTest(
-            model_challenger=loaded_model_challenger.model,
-            model_current=loaded_model_current.model,
+            challenger_predictions=challenger_predictions,
+            current_predictions=current_predictions,
             test_data=test_data,
-            target_col=config["main"]["target_column"],
+            target_col=target_col,
+            challenger_slice_metrics=challenger_slice_metrics,
+            current_slice_metrics=current_slice_metrics,
+            max_slice_mae_regression=config["main"].get("max_slice_mae_regression_to_promote", None),
+            min_slice_rows=min_slice_rows,
         )
 
         model_to_be_promoted = (
@@ -0,0 +1,157 @@
+"""
+Module for out of core training of ridge regression pipelines.
+
+The training data is streamed from parquet one batch at a time, and the sufficient statistics of ridge
+regression, the means and centered cross products of the features and the target, are accumulated per
+cross validation fold in a single pass. The model of every fold, and the model trained on all data, are
+solved exactly from the accumulators, and a second pass evaluates the folds on their hold out rows.
+Memory use is bounded by the batch size and the number of features, independent of the number of rows.
+"""
+from typing import List, Tuple
+import logging
+
+import numpy as np
+
+from src.models.evaluation import StreamingRegressionEvaluation
+from src.utils.artifacts import DataFrameArtifactSource
+
+logger = logging.getLogger(__name__)
+
+
+class RidgeAccumulator:
+    """Running means and centered cross products of the features and the target.
+
+    Accumulators of disjoint sets of rows are merged with the pairwise update of Chan et al.,
+    which avoids the loss of precision of accumulating raw cross products.
+    """
+
+    def __init__(self, n_features: int):
+        self.n_rows = 0
+        self.mean = np.zeros(n_features + 1)
+        self.comoment = np.zeros((n_features + 1, n_features + 1))
+
+    def merge(self, other: "RidgeAccumulator") -> "RidgeAccumulator":
+        """Add the rows of another accumulator to this one."""
+        if other.n_rows == 0:
+            return self
+        n_rows = self.n_rows + other.n_rows
+        delta = other.mean - self.mean
+        self.comoment = self.comoment + other.comoment + np.outer(delta, delta) * self.n_rows * other.n_rows / n_rows
+        self.mean = self.mean + delta * other.n_rows / n_rows
+        self.n_rows = n_rows
+        return self
+
+    def update(self, X: np.ndarray, y: np.ndarray) -> "RidgeAccumulator":
+        """Add a batch of rows."""
+        if len(y) == 0:
+            return self
+        batch = RidgeAccumulator(X.shape[1])
+        values = np.column_stack([X, y]).astype(np.float64, copy=False)
+        batch.n_rows = len(values)
+        batch.mean = values.mean(axis=0)
+        centered = values - batch.mean
+        batch.comoment = centered.T @ centered
+        return self.merge(batch)
+
+    def solve(self, alpha: float, fit_intercept: bool = True) -> Tuple[np.ndarray, float]:
+        """Solve for the coefficients and intercept of ridge regression on the accumulated rows.
+        Gives the same solution as sklearn.linear_model.Ridge, with an unpenalized intercept.
+        """
+        n_features = len(self.mean) - 1
+        cross_products = self.comoment
+        if not fit_intercept:
+            cross_products = self.comoment + self.n_rows * np.outer(self.mean, self.mean)
+        coef = np.linalg.solve(
+            cross_products[:n_features, :n_features] + alpha * np.eye(n_features),
+            cross_products[:n_features, n_features],
+        )
+        intercept = float(self.mean[n_features] - self.mean[:n_features] @ coef) if fit_intercept else 0.0
+        return coef, intercept
+
+
+def merge_accumulators(accumulators: List[RidgeAccumulator], n_features: int) -> RidgeAccumulator:
+    merged = RidgeAccumulator(n_features)
+    for accumulator in accumulators:
+        merged.merge(accumulator)
+    return merged
+
+
+def kfold_ends(n_rows: int, n_splits: int) -> np.ndarray:
+    """End row of every fold, splitting the rows like sklearn.model_selection.KFold without shuffling."""
+    if n_splits < 2 or n_splits > n_rows:
+        raise ValueError(f"Cannot split {n_rows} rows in {n_splits} folds.")
+    fold_sizes = np.full(n_splits, n_rows // n_splits)
+    fold_sizes[:n_rows % n_splits] += 1
+    return np.cumsum(fold_sizes)
+
+
+def _fold_batches(source: DataFrameArtifactSource, columns: List[str], fold_ends: np.ndarray, batch_size: int):
+    """Stream the batches of the source, with the fold of every row."""
+    start = 0
+    for batch in source.iter_batches(columns=columns, batch_size=batch_size):
+        folds = np.searchsorted(fold_ends, np.arange(start, start + len(batch)), side="right")
+        start += len(batch)
+        yield batch, folds
+
+
+def fit_streaming_ridge(
+    pipeline,
+    source: DataFrameArtifactSource,
+    target_column: str,
+    cv: int = 5,
+    batch_size: int = 65536,
+) -> StreamingRegressionEvaluation:
+    """Fit a ridge pipeline on streamed data, and evaluate it with cross validation.
+
+    The folds are the ones `cross_val_predict` uses for the same number of folds, so the metrics
+    equal the in memory cross validation. The pipeline is fitted in place on all rows.
+    :pipeline: Pipeline with a ColumnSelector step `column_selector` and a Ridge step `regressor`.
+    :return: Evaluation of the cross validation predictions.
+    """
+    from sklearn.linear_model import Ridge
+
+    regressor = pipeline["regressor"]
+    if not isinstance(regressor, Ridge):
+        raise ValueError(
+            f"Streaming training needs a Ridge regressor, got {type(regressor).__name__}. "
+            "Use evaluation.training_mode=in_memory."
+        )
+    features = list(pipeline["column_selector"].columns)
+    columns = features + [target_column]
+    n_rows = source.n_rows
+    fold_ends = kfold_ends(n_rows, cv)
+
+    logger.info(f"Accumulating sufficient statistics of {cv} folds over {n_rows} rows.")
+    accumulators = [RidgeAccumulator(len(features)) for _ in range(cv)]
+    for batch, folds in _fold_batches(source, columns, fold_ends, batch_size):
+        X = batch[features].to_numpy(dtype=np.float64)
+        y = batch[target_column].to_numpy(dtype=np.float64)
+        for fold in np.unique(folds):
+            in_fold = folds == fold
+            accumulators[fold].update(X[in_fold], y[in_fold])
+
+    logger.info("Solving fold models.")
+    fold_models = [
+        merge_accumulators(accumulators[:fold] + accumulators[fold + 1:], len(features)).solve(
+            regressor.alpha, regressor.fit_intercept
+        )
+        for fold in range(cv)
+    ]
+    fold_coefs = np.vstack([coef for coef, _ in fold_models])
+    fold_intercepts = np.array([intercept for _, intercept in fold_models])
+
+    logger.info("Predicting hold out folds.")
+    evaluation = StreamingRegressionEvaluation(n_rows=n_rows)
+    for batch, folds in _fold_batches(source, columns, fold_ends, batch_size):
+        X = batch[features].to_numpy(dtype=np.float64)
+        predictions = np.einsum("ij,ij->i", X, fold_coefs[folds]) + fold_intercepts[folds]
+        evaluation.update(batch[target_column].to_numpy(dtype=np.float64), predictions)
+
+    logger.info("Solving model on all data.")
+    coef, intercept = merge_accumulators(accumulators, len(features)).solve(regressor.alpha, regressor.fit_intercept)
+    regressor.coef_ = coef
+    regressor.intercept_ = intercept
+    regressor.n_features_in_ = len(features)
+    regressor.feature_names_in_ = np.array(features, dtype=object)
+    regressor.n_iter_ = None
+    return evaluation
@@ -3,35 +3,75 @@ Module for training and evaluating a model.
 
 A model configuration that implements the interface found in
 src.models.model_pipeliene_configs.BasePipelineConfig is passed supplied through the Hyrda configuration.
+
+With `evaluation.training_mode=streaming`, ridge pipelines are trained out of core, streaming the
+training data in batches of `evaluation.streaming_batch_size` rows. See src.models.streaming.
+
+The logged model is set with `evaluation.final_model`:
+- refit: The pipeline refitted on all data after cross validation.
+- cv_ensemble: An averaging ensemble of the pipelines fitted on the cross validation folds.
+  Saves the refit, and the cross validation metrics describe the logged model directly.
+
+With `evaluation.adaptive_n_estimators.enabled`, the number of trees of a random forest is chosen by
+growing it until the out-of-bag error converges, see src.models.adaptive_forest.
+Cross validation then uses the chosen number of trees. With refit, the forest is grown on all data
+and is the refit. With cv_ensemble, it is grown on the training rows of the first fold only, as no
+model is fitted on all data.
 """
 from tempfile import TemporaryDirectory
-from typing import Type
+from typing import List, Tuple, Type
 import logging
 
-import mlflow.pyfunc
-from sklearn.model_selection import cross_val_predict
-import wandb
 import hydra
+import numpy as np
+import pandas as pd
 
+from src.models.ensemble import AveragingEnsemble
 from src.models.evaluation import RegressionEvaluation
 from src.models import model_pipeliene_configs
 from src.models.model_pipeliene_configs import BasePipelineConfig
-from src.utils.artifacts import read_dataframe_artifact, log_dir, log_file
-from src.utils.models import MLFlowModelWrapper, set_seed
+from src.utils.artifact_backends import get_artifact_backend
+from src.utils.artifacts import get_dataframe_artifact_source, read_dataframe_artifact, log_dir, log_file
+from src.utils.seed import set_seed
 
 logger = logging.getLogger(__name__)
 
 
+def cross_val_predict_with_estimators(pipeline, df: pd.DataFrame, y: pd.Series, cv: int) -> Tuple[np.ndarray, List]:
+    """Predict on hold out data using cross validation, like sklearn's `cross_val_predict`,
+    and also return the pipelines fitted on the folds.
+    """
+    from sklearn.base import clone
+    from sklearn.model_selection import KFold
+
+    predictions = np.empty(len(df), dtype=np.float64)
+    fold_pipelines = []
+    for fold, (train_index, test_index) in enumerate(KFold(n_splits=cv).split(df)):
+        logger.info(f"Fit fold {fold + 1} of {cv}.")
+        fold_pipeline = clone(pipeline).fit(df.iloc[train_index], y.iloc[train_index])
+        predictions[test_index] = fold_pipeline.predict(df.iloc[test_index])
+        fold_pipelines.append(fold_pipeline)
+    return predictions, fold_pipelines
+
+
 def train_evaluate(
     pipeline_class: Type[BasePipelineConfig],
     config: dict,
 ):
+    import mlflow.pyfunc
+    import wandb
+    from sklearn.model_selection import cross_val_predict
+
+    from src.utils.models import MLFlowModelWrapper
+
     run = wandb.init(
         project=config["main"]["project_name"],
         job_type="cross_validation",
         group=config["main"]["experiment_name"],
-        config=dict(config)
+        config=dict(config),
+        mode=config["artifact_backend"]["wandb_mode"],
     )
+    backend = get_artifact_backend(config, run)
 
     logger.info("Fix seed.")
     seed = set_seed()
@@ -39,50 +79,109 @@ def train_evaluate(
 
     target_column = config["main"]["target_column"]
 
-    logger.info("Load data from training model.")
-    df = read_dataframe_artifact(run, **config["artifacts"]["train_validate_data"])
-
     logger.info("Initialize ml pipeline object.")
     pipeline = pipeline_class.get_pipeline(**(config["model"]["params"]))
+    final_model = config["evaluation"].get("final_model", "refit")
+    if final_model not in ("refit", "cv_ensemble"):
+        raise ValueError(f"Unknown final_model {final_model}. Use refit or cv_ensemble.")
+    model = pipeline
+
+    if config["evaluation"].get("training_mode", "in_memory") == "streaming":
+        from src.models.streaming import fit_streaming_ridge
+
+        if final_model == "cv_ensemble":
+            logger.warning("Streaming training solves the model on all data without a refit. Ignoring cv_ensemble.")
+        logger.info("Stream data for cross validation and training model on all data.")
+        model_evaluation = fit_streaming_ridge(
+            pipeline,
+            source=get_dataframe_artifact_source(backend, **config["artifacts"]["train_validate_data"]),
+            target_column=target_column,
+            cv=config["evaluation"]["cross_validation_folds"],
+            batch_size=config["evaluation"].get("streaming_batch_size", 65536),
+        )
+    else:
+        logger.info("Load data from training model.")
+        df = read_dataframe_artifact(backend, **config["artifacts"]["train_validate_data"])
+
+        adaptive_n_estimators = config["evaluation"].get("adaptive_n_estimators", None) or {}
+        fitted_on_all_data = False
+        if adaptive_n_estimators.get("enabled", False):
+            from sklearn.base import clone
+            from sklearn.model_selection import KFold
+
+            from src.models.adaptive_forest import grow_forest
+
+            if final_model == "cv_ensemble":
+                logger.info("Grow forest on the first fold until the out-of-bag error converges.")
+                train_index, _ = next(KFold(n_splits=config["evaluation"]["cross_validation_folds"]).split(df))
+                grow_df, grow_pipeline = df.iloc[train_index], clone(pipeline)
+            else:
+                logger.info("Grow forest on all data until the out-of-bag error converges.")
+                grow_df, grow_pipeline = df, pipeline
+            n_estimators, oob_mse_history = grow_forest(
+                grow_pipeline,
+                grow_df,
+                grow_df[target_column],
+                increment=adaptive_n_estimators.get("increment", 25),
+                max_n_estimators=adaptive_n_estimators.get("max_n_estimators", 500),
+                tol=adaptive_n_estimators.get("tol", 0.005),
+            )
+            pipeline.set_params(regressor__n_estimators=n_estimators)
+            fitted_on_all_data = final_model == "refit"
+            for n_trees, oob_mse in oob_mse_history:
+                run.log({"oob_n_estimators": n_trees, "oob_mse": oob_mse})
+            run.summary["n_estimators"] = n_estimators
+            logger.info(f"Chose {n_estimators} trees.")
+
+        if final_model == "cv_ensemble":
+            logger.info("predict on hold out data using cross validation, keeping the fold models.")
+            predictions, fold_pipelines = cross_val_predict_with_estimators(
+                pipeline, df, df[target_column], cv=config["evaluation"]["cross_validation_folds"]
+            )
+            model = AveragingEnsemble(fold_pipelines)
+        else:
+            logger.info("predict on hold out data using cross validation.")
+            predictions = cross_val_predict(
+                estimator=pipeline,
+                X=df,
+                y=df[target_column],
+                cv=config["evaluation"]["cross_validation_folds"],
+                verbose=3,
+            )
+
+        model_evaluation = RegressionEvaluation(
+            y_true=df[target_column],
+            y_pred=predictions,
+        )
 
-    logger.info("predict on hold out data using cross validation.")
-    predictions = cross_val_predict(
-        estimator=pipeline,
-        X=df,
-        y=df[target_column],
-        cv=config["evaluation"]["cross_validation_folds"],
-        verbose=3,
-    )
-
-    model_evaluation = RegressionEvaluation(
-        y_true=df[target_column],
-        y_pred=predictions,
-    )
-
-    logger.info("train on model on all data")
-    pipeline.fit(df, df[target_column])
+        if final_model == "refit" and not fitted_on_all_data:
+            logger.info("train on model on all data")
+            pipeline.fit(df, df[target_column])
 
     logger.info("Logging performance metrics.")
     run.summary.update(model_evaluation.get_metrics())
+    run.summary["final_model"] = "cv_ensemble" if isinstance(model, AveragingEnsemble) else "refit"
 
     wandb.log(model_evaluation.get_metrics())
 
     logger.info("Logging model evaluation artifacts.")
     with TemporaryDirectory() as tmpdirname:
         model_evaluation.save_evaluation_artifacts(out_dir=tmpdirname)
-        pipeline_class.save_fitted_pipeline_plots(pipeline, out_dir=tmpdirname)
-        log_dir(run=run, dir_path=tmpdirname, **config["artifacts"]["evaluation"])
+        pipeline_class.save_fitted_pipeline_plots(
+            model.members[0] if isinstance(model, AveragingEnsemble) else model, out_dir=tmpdirname
+        )
+        log_dir(backend=backend, dir_path=tmpdirname, **config["artifacts"]["evaluation"])
 
     logger.info("Logging model trained on all data.")
     with TemporaryDirectory() as tmpdirname:
         mlflow.pyfunc.save_model(
-            python_model=MLFlowModelWrapper(pipeline),
+            python_model=MLFlowModelWrapper(model),
             path=f'{tmpdirname}/model',
             conda_env=pipeline_class.get_conda_env(),
             code_path=["src"],
         )
 
-        log_dir(run=run, dir_path=tmpdirname, **config["artifacts"]["model"])
+        log_dir(backend=backend, dir_path=tmpdirname, **config["artifacts"]["model"])
 
 
 @hydra.main(config_path="../../conf", config_name="config")
@@ -0,0 +1,526 @@
+"""
+Backends for storing and versioning artifacts.
+
+Every stage reads and writes its artifacts through an `ArtifactBackend`, selected with the Hydra
+`artifact_backend` config group:
+- wandb: Weights and Biases artifacts.
+- local: A directory on the local filesystem, with the versions, aliases and lineage kept in a SQLite database.
+  Needs no network access, so the pipelines can run on offline nodes and at local disk speed.
+"""
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+import json
+import logging
+import shutil
+import sqlite3
+import time
+import uuid
+
+from src.exceptions import ArtifactDoesNoteExistError
+
+logger = logging.getLogger(__name__)
+
+
+class ArtifactVersion(ABC):
+    """A single version of an artifact."""
+
+    @property
+    @abstractmethod
+    def name(self) -> str:
+        """Name of the artifact."""
+
+    @property
+    @abstractmethod
+    def version(self) -> str:
+        """Version of the artifact, e.g. v3."""
+
+    @property
+    @abstractmethod
+    def id(self) -> str:
+        """Unique id of the artifact version."""
+
+    @property
+    @abstractmethod
+    def aliases(self) -> List[str]:
+        """Aliases pointing to the artifact version, e.g. latest and prod."""
+
+    @property
+    @abstractmethod
+    def metadata(self) -> dict:
+        """Metadata logged with the artifact version."""
+
+    @property
+    @abstractmethod
+    def run_id(self) -> Optional[str]:
+        """Id of the run that logged the artifact version."""
+
+    @abstractmethod
+    def download(self) -> str:
+        """Get the artifact version locally and return the path of its directory."""
+
+    @abstractmethod
+    def file(self) -> str:
+        """Get a single file artifact version locally and return the path of the file."""
+
+
+class ArtifactBackend(ABC):
+    """Interface for storing and versioning artifacts."""
+
+    @abstractmethod
+    def log_file(
+        self, file_path: str, type: str, name: str, description: str = "", metadata: Optional[dict] = None
+    ) -> None:
+        """Log a file as a new version of an artifact."""
+
+    @abstractmethod
+    def log_dir(
+        self, dir_path: str, type: str, name: str, description: str = "", metadata: Optional[dict] = None
+    ) -> None:
+        """Log the content of a directory as a new version of an artifact."""
+
+    @abstractmethod
+    def get_artifact(self, name: str, version: str) -> ArtifactVersion:
+        """Get an artifact version, without declaring it as input to the current run.
+        `version` can be a version, like v3, or an alias, like latest.
+        Raises ArtifactDoesNoteExistError if the version does not exist.
+        """
+
+    @abstractmethod
+    def use_artifact(self, name: str, version: str) -> ArtifactVersion:
+        """Get an artifact version and declare it as input to the current run."""
+
+    def resolve_alias(self, name: str, alias: str) -> str:
+        """Get the version an alias points to."""
+        return self.get_artifact(name, alias).version
+
+    @abstractmethod
+    def lineage(self, name: str, version: str) -> List[str]:
+        """Get the artifacts, as name:version, used by the run that logged an artifact version.
+        They are in the order they were used in.
+        """
+
+    @abstractmethod
+    def promote(self, name: str, version: str, alias: str) -> None:
+        """Point an alias to an artifact version."""
+
+    def invalidate(self, name: str) -> None:
+        """Drop anything cached about the versions and aliases of an artifact."""
+
+
+class WandbArtifactVersion(ArtifactVersion):
+    """Version of a Weights and Biases artifact."""
+
+    def __init__(self, artifact):
+        self.artifact = artifact
+        self._logged_by = None
+
+    def logged_by(self):
+        """The run that logged the artifact version. Fetched once."""
+        if self._logged_by is None:
+            self._logged_by = self.artifact.logged_by()
+        return self._logged_by
+
+    @property
+    def name(self) -> str:
+        return self.artifact.name.split(":")[0]
+
+    @property
+    def version(self) -> str:
+        return self.artifact.version
+
+    @property
+    def id(self) -> str:
+        return self.artifact.id
+
+    @property
+    def aliases(self) -> List[str]:
+        return list(self.artifact.aliases)
+
+    @property
+    def metadata(self) -> dict:
+        return dict(self.artifact.metadata or {})
+
+    @property
+    def run_id(self) -> Optional[str]:
+        run = self.logged_by()
+        return run.id if run is not None else None
+
+    def download(self) -> str:
+        return self.artifact.download()
+
+    def file(self) -> str:
+        return self.artifact.file()
+
+
+_WANDB_API = None
+_WANDB_API_LOCK = Lock()
+
+
+def get_wandb_api():
+    """Get the process wide wandb API client, so every stage reuses a single session."""
+    global _WANDB_API
+    import wandb
+
+    with _WANDB_API_LOCK:
+        if _WANDB_API is None:
+            _WANDB_API = wandb.Api()
+        return _WANDB_API
+
+
+class WandbArtifactBackend(ArtifactBackend):
+    """Artifact backend storing artifacts in Weights and Biases.
+
+    Resolved artifact versions, including their aliases and metadata, are cached for `cache_ttl`
+    seconds, so resolving e.g. model:prod several times in a stage only calls the API once.
+    The cache of an artifact is invalidated when one of its aliases is moved through the backend.
+    Logged artifacts upload in the background. Reading an artifact the stage logged itself waits for
+    its uploads first, other stages do not block on them.
+    :run: The active wandb run, that logged and used artifacts are attached to.
+    :project_name: Name of the wandb project.
+    :cache_ttl: Seconds a resolved artifact version is cached for. 0 disables the cache.
+    """
+
+    def __init__(self, run, project_name: str, cache_ttl: float = 300):
+        self.run = run
+        self.project_name = project_name
+        self.cache_ttl = cache_ttl
+        self._cache: Dict[Tuple[str, str], Tuple[float, WandbArtifactVersion]] = {}
+        self._lineage: Dict[str, List[str]] = {}
+        self._cache_lock = Lock()
+        self._pending_uploads: Dict[str, list] = {}
+
+    def _cached(self, name: str, version: str) -> Optional[WandbArtifactVersion]:
+        with self._cache_lock:
+            expires_at, artifact = self._cache.get((name, version), (0.0, None))
+            return artifact if time.monotonic() < expires_at else None
+
+    def _store(self, artifact: WandbArtifactVersion, version: str) -> None:
+        if self.cache_ttl <= 0:
+            return
+        expires_at = time.monotonic() + self.cache_ttl
+        with self._cache_lock:
+            for key in {version, artifact.version}:
+                self._cache[(artifact.name, key)] = (expires_at, artifact)
+
+    def invalidate(self, name: str) -> None:
+        with self._cache_lock:
+            for key in [key for key in self._cache if key[0] == name]:
+                del self._cache[key]
+
+    def _wait_for_uploads(self, name: str) -> None:
+        with self._cache_lock:
+            pending = self._pending_uploads.pop(name, [])
+        for artifact in pending:
+            artifact.wait()
+
+    def _fetch(self, name: str, version: str) -> WandbArtifactVersion:
+        import wandb
+
+        self._wait_for_uploads(name)
+        try:
+            artifact = WandbArtifactVersion(get_wandb_api().artifact(f"{self.project_name}/{name}:{version}"))
+        except wandb.errors.CommError as e:
+            raise ArtifactDoesNoteExistError(f"Artifact {name}:{version} does not exist. From WANDB: {e}")
+        self._store(artifact, version)
+        return artifact
+
+    def _log(self, artifact) -> None:
+        self.run.log_artifact(artifact)
+        name = artifact.name.split(":")[0]
+        with self._cache_lock:
+            self._pending_uploads.setdefault(name, []).append(artifact)
+        # Logging a version moves the latest alias.
+        self.invalidate(name)
+
+    def log_file(
+        self, file_path: str, type: str, name: str, description: str = "", metadata: Optional[dict] = None
+    ) -> None:
+        import wandb
+
+        artifact = wandb.Artifact(type=type, description=description, name=name, metadata=metadata)
+        artifact.add_file(file_path)
+        self._log(artifact)
+
+    def log_dir(
+        self, dir_path: str, type: str, name: str, description: str = "", metadata: Optional[dict] = None
+    ) -> None:
+        import wandb
+
+        artifact = wandb.Artifact(type=type, description=description, name=name, metadata=metadata)
+        artifact.add_dir(dir_path)
+        self._log(artifact)
+
+    def get_artifact(self, name: str, version: str) -> WandbArtifactVersion:
+        return self._cached(name, version) or self._fetch(name, version)
+
+    def use_artifact(self, name: str, version: str) -> WandbArtifactVersion:
+        import wandb
+
+        self._wait_for_uploads(name)
+        cached = self._cached(name, version)
+        try:
+            # An already resolved artifact is declared as input without resolving it again.
+            used = self.run.use_artifact(cached.artifact if cached else f"{name}:{version}")
+        except wandb.errors.CommError as e:
+            raise ArtifactDoesNoteExistError(f"Artifact {name}:{version} does not exist. From WANDB: {e}")
+        return cached or WandbArtifactVersion(used)
+
+    def lineage(self, name: str, version: str) -> List[str]:
+        artifact = self.get_artifact(name, version)
+        # The inputs of the run that logged a version never change, so they are cached without expiry.
+        if artifact.id not in self._lineage:
+            self._lineage[artifact.id] = [used.name for used in artifact.logged_by().used_artifacts()]
+        return self._lineage[artifact.id]
+
+    def promote(self, name: str, version: str, alias: str) -> None:
+        # Aliases are read fresh, as a cached version may not know about recent promotions.
+        artifact = self._fetch(name, version).artifact
+        if alias not in artifact.aliases:
+            artifact.aliases.append(alias)
+            artifact.save()
+        self.invalidate(name)
+
+
+class LocalArtifactVersion(ArtifactVersion):
+    """Version of an artifact stored by the local artifact backend."""
+
+    def __init__(
+        self, name: str, version: str, path: Path, aliases: List[str], metadata: dict, run_id: Optional[str]
+    ):
+        self._name = name
+        self._version = version
+        self._path = path
+        self._aliases = aliases
+        self._metadata = metadata
+        self._run_id = run_id
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def version(self) -> str:
+        return self._version
+
+    @property
+    def id(self) -> str:
+        return f"{self._name}:{self._version}"
+
+    @property
+    def aliases(self) -> List[str]:
+        return list(self._aliases)
+
+    @property
+    def metadata(self) -> dict:
+        return dict(self._metadata)
+
+    @property
+    def run_id(self) -> Optional[str]:
+        return self._run_id
+
+    def download(self) -> str:
+        return str(self._path)
+
+    def file(self) -> str:
+        files = [path for path in self._path.iterdir() if path.is_file()]
+        if len(files) != 1:
+            raise ValueError(f"Artifact {self.id} holds {len(files)} files, expected a single file.")
+        return str(files[0])
+
+
+class LocalArtifactBackend(ArtifactBackend):
+    """Artifact backend storing artifacts in a local directory.
+
+    Versions are stored as <root>/<name>/<version>. Versions, aliases and lineage are kept in
+    <root>/artifacts.db. A new version is first written to a temporary directory and then moved
+    in place and registered in a single database transaction, so readers never see partial versions.
+    :root: Root directory of the artifact store.
+    :run_id: Id of the current run, used to record lineage. A random id is used if None.
+    """
+
+    def __init__(self, root: str, run_id: Optional[str] = None):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.run_id = run_id or uuid.uuid4().hex
+        connection = self._connect()
+        try:
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS versions (
+                    name TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    type TEXT NOT NULL,
+                    description TEXT,
+                    metadata TEXT NOT NULL,
+                    run_id TEXT,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (name, version)
+                );
+                CREATE TABLE IF NOT EXISTS aliases (
+                    name TEXT NOT NULL,
+                    alias TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    PRIMARY KEY (name, alias)
+                );
+                CREATE TABLE IF NOT EXISTS used_artifacts (
+                    run_id TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    version INTEGER NOT NULL
+                );
+            """)
+        finally:
+            connection.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.root / "artifacts.db", timeout=60, isolation_level=None)
+
+    @contextmanager
+    def _transaction(self, mode: str = "IMMEDIATE"):
+        """Run a transaction, committed unless the body already did.
+
+        :mode: IMMEDIATE takes the write lock at the start, DEFERRED only on the first write, so
+            read only transactions do not block writers.
+        """
+        connection = self._connect()
+        try:
+            connection.execute(f"BEGIN {mode}")
+            yield connection
+            if connection.in_transaction:
+                connection.execute("COMMIT")
+        except BaseException:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            raise
+        finally:
+            connection.close()
+
+    def _log(self, copy_to, type: str, name: str, description: str, metadata: Optional[dict]) -> None:
+        staging_dir = self.root / ".staging" / uuid.uuid4().hex
+        staging_dir.mkdir(parents=True)
+        try:
+            copy_to(staging_dir)
+            with self._transaction() as connection:
+                (latest,) = connection.execute(
+                    "SELECT COALESCE(MAX(version), -1) FROM versions WHERE name = ?", (name,)
+                ).fetchone()
+                version = latest + 1
+                version_dir = self.root / name / f"v{version}"
+                version_dir.parent.mkdir(parents=True, exist_ok=True)
+                if version_dir.exists():
+                    # Left behind by a process that died between moving the directory and committing.
+                    # The version has no row, and the write lock is held, so nobody else can own it.
+                    logger.warning(f"Removing unregistered directory {version_dir}.")
+                    shutil.rmtree(version_dir)
+                staging_dir.rename(version_dir)
+                try:
+                    connection.execute(
+                        "INSERT INTO versions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (name, version, type, description, json.dumps(metadata or {}), self.run_id, time.time()),
+                    )
+                    connection.execute(
+                        "INSERT OR REPLACE INTO aliases VALUES (?, 'latest', ?)", (name, version)
+                    )
+                    # Commit while the write lock is still held, so the version directory can be moved
+                    # back if the commit fails, instead of being left orphaned.
+                    connection.execute("COMMIT")
+                except BaseException:
+                    version_dir.rename(staging_dir)
+                    raise
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def log_file(
+        self, file_path: str, type: str, name: str, description: str = "", metadata: Optional[dict] = None
+    ) -> None:
+        self._log(
+            lambda staging_dir: shutil.copy2(file_path, staging_dir / Path(file_path).name),
+            type, name, description, metadata,
+        )
+
+    def log_dir(
+        self, dir_path: str, type: str, name: str, description: str = "", metadata: Optional[dict] = None
+    ) -> None:
+        self._log(
+            lambda staging_dir: shutil.copytree(dir_path, staging_dir, dirs_exist_ok=True),
+            type, name, description, metadata,
+        )
+
+    @staticmethod
+    def _version_number(connection, name: str, version: str) -> int:
+        if version.startswith("v") and version[1:].isdigit():
+            row = connection.execute(
+                "SELECT version FROM versions WHERE name = ? AND version = ?", (name, int(version[1:]))
+            ).fetchone()
+        else:
+            row = connection.execute(
+                "SELECT version FROM aliases WHERE name = ? AND alias = ?", (name, version)
+            ).fetchone()
+        if row is None:
+            raise ArtifactDoesNoteExistError(f"Artifact {name}:{version} does not exist.")
+        return row[0]
+
+    def _get(self, connection, name: str, version: str) -> LocalArtifactVersion:
+        number = self._version_number(connection, name, version)
+        metadata, run_id = connection.execute(
+            "SELECT metadata, run_id FROM versions WHERE name = ? AND version = ?", (name, number)
+        ).fetchone()
+        aliases = [
+            alias for (alias,) in connection.execute(
+                "SELECT alias FROM aliases WHERE name = ? AND version = ?", (name, number)
+            )
+        ]
+        return LocalArtifactVersion(
+            name=name,
+            version=f"v{number}",
+            path=self.root / name / f"v{number}",
+            aliases=aliases,
+            metadata=json.loads(metadata),
+            run_id=run_id,
+        )
+
+    def get_artifact(self, name: str, version: str) -> LocalArtifactVersion:
+        with self._transaction("DEFERRED") as connection:
+            return self._get(connection, name, version)
+
+    def use_artifact(self, name: str, version: str) -> LocalArtifactVersion:
+        with self._transaction() as connection:
+            artifact = self._get(connection, name, version)
+            connection.execute(
+                "INSERT INTO used_artifacts VALUES (?, ?, ?)", (self.run_id, name, int(artifact.version[1:]))
+            )
+        return artifact
+
+    def lineage(self, name: str, version: str) -> List[str]:
+        with self._transaction("DEFERRED") as connection:
+            run_id = self._get(connection, name, version).run_id
+            return [
+                f"{used_name}:v{used_version}" for used_name, used_version in connection.execute(
+                    "SELECT name, version FROM used_artifacts WHERE run_id = ? ORDER BY rowid", (run_id,)
+                )
+            ]
+
+    def promote(self, name: str, version: str, alias: str) -> None:
+        with self._transaction() as connection:
+            number = self._version_number(connection, name, version)
+            connection.execute("INSERT OR REPLACE INTO aliases VALUES (?, ?, ?)", (name, alias, number))
+
+
+def get_artifact_backend(config, run) -> ArtifactBackend:
+    """Get the artifact backend selected in the Hydra `artifact_backend` config group."""
+    backend_config = config["artifact_backend"]
+    if backend_config["type"] == "wandb":
+        return WandbArtifactBackend(
+            run,
+            project_name=config["main"]["project_name"],
+            cache_ttl=backend_config.get("cache_ttl", 300),
+        )
+    if backend_config["type"] == "local":
+        from hydra.utils import to_absolute_path
+
+        return LocalArtifactBackend(
+            root=to_absolute_path(backend_config["root"]),
+            run_id=getattr(run, "id", None),
+        )
+    raise ValueError(f"Unknown artifact backend {backend_config['type']}. Use wandb or local.")
@@ -1,70 +1,177 @@
-"""Utilities for working with weights and biases artifacts"""
+"""Utilities for working with artifacts, stored through an artifact backend."""
 import logging
+from dataclasses import dataclass
+from pathlib import Path
 from tempfile import TemporaryDirectory
-from typing import Optional
+from typing import Iterator, List, Optional
 
+import numpy as np
 import pandas as pd
-import wandb
 
-from src.exceptions import ArtifactDoesNoteExistError
+from src.utils.artifact_backends import ArtifactBackend, ArtifactVersion
 
 
 logger = logging.getLogger(__name__)
 
+# Metadata key marking an artifact as a row selection of another dataframe artifact.
+ROW_SELECTION_SOURCE_KEY = "row_selection_of"
 
-def log_file(run, file_path: str, type: str, name: str, description: Optional[str] = "", **kwargs) -> None:
-    _ = kwargs
-    artifact = wandb.Artifact(
-        type=type,
-        description=description,
-        name=name,
-    )
-    artifact.add_file(file_path)
 
+def log_file(
+    backend: ArtifactBackend,
+    file_path: str,
+    type: str,
+    name: str,
+    description: Optional[str] = "",
+    metadata: Optional[dict] = None,
+    **kwargs,
+) -> None:
+    _ = kwargs
     logger.info(f"Logging artifact file {name}")
-    run.log_artifact(artifact)
-
-    artifact.wait()
-
-
-def log_dir(run, dir_path: str, type: str, name: str, description: Optional[str] = "", **kwargs) -> None:
+    backend.log_file(file_path, type=type, name=name, description=description, metadata=metadata)
+
+
+def log_dir(
+    backend: ArtifactBackend,
+    dir_path: str,
+    type: str,
+    name: str,
+    description: Optional[str] = "",
+    metadata: Optional[dict] = None,
+    **kwargs,
+) -> None:
     _ = kwargs
-    artifact = wandb.Artifact(
-        type=type,
-        description=description,
-        name=name,
-    )
-    artifact.add_dir(dir_path)
-
     logger.info(f"Logging artifact directory {name}")
-    run.log_artifact(artifact)
-
-    artifact.wait()
+    backend.log_dir(dir_path, type=type, name=name, description=description, metadata=metadata)
 
 
-def log_dataframe(run, df: pd.DataFrame, type: str, name: str, description: Optional[str] = "", **kwargs) -> None:
+def log_dataframe(
+    backend: ArtifactBackend, df: pd.DataFrame, type: str, name: str, description: Optional[str] = "", **kwargs
+) -> None:
     _ = kwargs
     with TemporaryDirectory() as tmpdirname:
-        file_name = tmpdirname + "artifacts.parquet"
+        file_name = str(Path(tmpdirname) / "artifacts.parquet")
         df.to_parquet(file_name)
-        log_file(run, file_name, type, name, description)
+        log_file(backend, file_name, type, name, description)
+
+
+def log_row_selection(
+    backend: ArtifactBackend,
+    mask: np.ndarray,
+    source_name: str,
+    source_version: str,
+    type: str,
+    name: str,
+    description: Optional[str] = "",
+    **kwargs,
+) -> None:
+    """Log a selection of rows of a dataframe artifact as a bitmap, instead of a copy of the rows.
+
+    The artifact is read back as a dataframe by `read_dataframe_artifact`.
+    :mask: Boolean array with one element per row of the source artifact.
+    :source_name: Name of the dataframe artifact the rows are selected from.
+    :source_version: Version of the dataframe artifact the rows are selected from, e.g. v3.
+    """
+    _ = kwargs
+    with TemporaryDirectory() as tmpdirname:
+        file_name = str(Path(tmpdirname) / "row_selection.npz")
+        np.savez_compressed(file_name, bitmap=np.packbits(mask), n_rows=len(mask))
+        log_file(
+            backend,
+            file_name,
+            type,
+            name,
+            description,
+            metadata={ROW_SELECTION_SOURCE_KEY: f"{source_name}:{source_version}"},
+        )
+
+
+def use_artifact(backend: ArtifactBackend, name: str, version: str, **kwargs) -> ArtifactVersion:
+    """Declare an artifact as input to the run and return it."""
+    _ = kwargs
+    logger.info(f"Using artifact {name}:{version}")
+    return backend.use_artifact(name, version)
 
 
-def read_dataframe_artifact(run, name: str, version: str, **kwargs) -> pd.DataFrame:
-    artifact_tag = f"{name}:{version}"
+def get_artifact_file_path(backend: ArtifactBackend, name: str, version: str, **kwargs) -> str:
+    """Download a single file artifact and return the local path to the file."""
+    _ = kwargs
+    return use_artifact(backend, name=name, version=version).file()
+
+
+def read_dataframe_artifact(backend: ArtifactBackend, name: str, version: str, **kwargs) -> pd.DataFrame:
+    _ = kwargs
+    artifact = use_artifact(backend, name=name, version=version)
+    source = artifact.metadata.get(ROW_SELECTION_SOURCE_KEY)
+    if source is None:
+        return pd.read_parquet(artifact.file())
+
+    logger.info(f"Artifact {name}:{version} is a row selection of {source}")
+    with np.load(artifact.file()) as row_selection:
+        mask = np.unpackbits(row_selection["bitmap"], count=int(row_selection["n_rows"])).astype(bool)
+    source_name, source_version = source.split(":")
+    df = read_dataframe_artifact(backend, name=source_name, version=source_version)
+    return df.iloc[np.flatnonzero(mask)]
+
+
+def _unpack_bits(bitmap: np.ndarray, start: int, stop: int) -> np.ndarray:
+    """Unpack the bits from position `start` up to `stop` of a bitmap as a boolean array."""
+    bits = np.unpackbits(bitmap[start // 8:(stop + 7) // 8])
+    offset = start % 8
+    return bits[offset:offset + stop - start].astype(bool)
+
+
+@dataclass
+class DataFrameArtifactSource:
+    """A dataframe artifact that can be read in batches, without loading it in memory.
+
+    :file_path: Local path of the parquet file holding the rows.
+    :bitmap: Packed bitmap of the rows of the file that belong to the artifact. All rows if None.
+    """
+    file_path: str
+    bitmap: Optional[np.ndarray] = None
+
+    @property
+    def n_rows(self) -> int:
+        if self.bitmap is not None:
+            return int(np.unpackbits(self.bitmap).sum())
+        import pyarrow.parquet as pq
+
+        return pq.ParquetFile(self.file_path).metadata.num_rows
+
+    def iter_batches(self, columns: Optional[List[str]] = None, batch_size: int = 65536) -> Iterator[pd.DataFrame]:
+        """Read the rows in batches of at most `batch_size` rows, in the order of the file."""
+        import pyarrow.parquet as pq
+
+        start = 0
+        for record_batch in pq.ParquetFile(self.file_path).iter_batches(batch_size=batch_size, columns=columns):
+            batch = record_batch.to_pandas()
+            stop = start + len(batch)
+            if self.bitmap is not None:
+                batch = batch[_unpack_bits(self.bitmap, start, stop)]
+            start = stop
+            yield batch
+
+
+def get_dataframe_artifact_source(
+    backend: ArtifactBackend, name: str, version: str, **kwargs
+) -> DataFrameArtifactSource:
+    """Get a dataframe artifact for reading it in batches. Row selections are applied batch by batch."""
     _ = kwargs
-    logger.info(f"Downloading artifact {artifact_tag}")
-    try:
-        artifact = run.use_artifact(artifact_tag)
-    except wandb.errors.CommError as e:
-        ArtifactDoesNoteExistError(f"Data version does not exist. From WANDB: {e}")
-    artifact_path = artifact.file()
-    return pd.read_parquet(artifact_path)
-
-
-def get_model_artifact(project_name: str, model_name: str, model_version: str):
-    api = wandb.Api()
-    try:
-        return api.artifact(f"{project_name}/{model_name}:{model_version}")
-    except wandb.errors.CommError as e:
-        raise ArtifactDoesNoteExistError(f"Trained model version does not exist. From WANDB: {e}")
+    artifact = use_artifact(backend, name=name, version=version)
+    source = artifact.metadata.get(ROW_SELECTION_SOURCE_KEY)
+    if source is None:
+        return DataFrameArtifactSource(file_path=artifact.file())
+
+    logger.info(f"Artifact {name}:{version} is a row selection of {source}")
+    with np.load(artifact.file()) as row_selection:
+        bitmap, n_rows = row_selection["bitmap"], int(row_selection["n_rows"])
+    source_name, source_version = source.split(":")
+    parent = get_dataframe_artifact_source(backend, name=source_name, version=source_version)
+    if parent.bitmap is None:
+        return DataFrameArtifactSource(file_path=parent.file_path, bitmap=bitmap)
+
+    # A selection of a selection is combined into a single selection of the file.
+    mask = np.unpackbits(parent.bitmap).astype(bool)
+    mask[np.flatnonzero(mask)] = np.unpackbits(bitmap, count=n_rows).astype(bool)
+    return DataFrameArtifactSource(file_path=parent.file_path, bitmap=np.packbits(mask))
@@ -0,0 +1,25 @@
+"""Utilities for applying the pipeline wide dtype policy, configured in the Hydra `dtypes` group."""
+from typing import Optional
+
+import pandas as pd
+
+
+def apply_dtype_policy(
+    df: pd.DataFrame,
+    features: str = "float64",
+    target: Optional[str] = None,
+    target_column: Optional[str] = None,
+    **kwargs
+) -> pd.DataFrame:
+    """Cast the floating point columns of a dataframe in place.
+
+    :features: dtype for all floating point columns, except the target column.
+    :target: dtype for the target column. Uses the feature dtype if None.
+    :target_column: Name of the target column.
+    """
+    _ = kwargs
+    for column in df.select_dtypes("floating").columns:
+        dtype = target if column == target_column and target else features
+        if df[column].dtype != dtype:
+            df[column] = df[column].astype(dtype)
+    return df
@@ -0,0 +1,154 @@
+"""
+Module with a fast path from parquet to predictions.
+
+The model pipelines select their features from a dataframe with a ColumnSelector, sklearn converts the
+selection to a numpy array again, and the mlflow pyfunc layer converts the input on top of that.
+This path reads only the feature columns into a single C ordered matrix, with one copy per column,
+and feeds it straight to the pipeline steps after the column selector.
+
+For a few rows at a time, `compile_predictor` goes further and turns a fitted pipeline into a plain
+function of the feature matrix, calling the estimator internals without sklearn's per call checks.
+
+The estimators are fitted on dataframes, so sklearn warns when they are given a matrix. Both paths
+take a pipeline prepared by `prepare_matrix_pipeline`, that checks the column order of the matrix
+once and drops the feature names of the estimators, instead of suppressing the warning.
+"""
+from typing import Callable, List
+
+import numpy as np
+import pandas as pd
+
+
+def read_feature_matrix(file_path: str, columns: List[str], dtype: str = "float64", batch_size: int = 65536) -> np.ndarray:
+    """Read the feature columns of a parquet file into a C ordered matrix with one column per feature.
+
+    Arrow buffers of the columns are viewed without copying, and copied once into the matrix.
+    Memory use is the matrix plus a single record batch of the feature columns.
+    """
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(file_path)
+    matrix = np.empty((parquet_file.metadata.num_rows, len(columns)), dtype=dtype)
+    start = 0
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+        stop = start + batch.num_rows
+        for j, column in enumerate(columns):
+            matrix[start:stop, j] = batch.column(batch.schema.get_field_index(column)).to_numpy(zero_copy_only=False)
+        start = stop
+    return matrix
+
+
+def dataframe_to_feature_matrix(df: pd.DataFrame, columns: List[str], dtype: str = "float64") -> np.ndarray:
+    """Copy the feature columns of a dataframe into a C ordered matrix, one column at a time."""
+    matrix = np.empty((len(df), len(columns)), dtype=dtype)
+    for j, column in enumerate(columns):
+        matrix[:, j] = df[column].to_numpy()
+    return matrix
+
+
+def prepare_matrix_pipeline(pipeline, columns: List[str]):
+    """Prepare a fitted pipeline, or AveragingEnsemble of pipelines, for predicting on feature matrices.
+
+    Checks that `columns` are the columns the first step after the column selector was fitted on,
+    in the same order, and replaces that step by a shallow copy without `feature_names_in_`.
+    The fitted parameters are shared with `pipeline`, which is left unchanged.
+    Raises ValueError if the columns do not match.
+    """
+    from copy import copy
+
+    from sklearn.pipeline import Pipeline
+
+    from src.models.ensemble import AveragingEnsemble
+
+    if hasattr(pipeline, "members"):
+        return AveragingEnsemble([prepare_matrix_pipeline(member, columns) for member in pipeline.members])
+
+    steps = list(pipeline.steps)
+    for i, (name, step) in enumerate(steps):
+        if name == "column_selector" or step == "passthrough":
+            continue
+        if hasattr(step, "feature_names_in_"):
+            if list(step.feature_names_in_) != list(columns):
+                raise ValueError(
+                    f"Step {name} was fitted on the columns {list(step.feature_names_in_)}, "
+                    f"but the feature matrix has the columns {list(columns)}."
+                )
+            step = copy(step)
+            del step.feature_names_in_
+            steps[i] = (name, step)
+        break
+    return Pipeline(steps)
+
+
+def predict_feature_matrix(pipeline, matrix: np.ndarray) -> np.ndarray:
+    """Predict with a fitted pipeline on a feature matrix, skipping its column selector.
+
+    The columns of the matrix must be in the order of the columns of the column selector, and the
+    pipeline prepared with `prepare_matrix_pipeline`.
+    The finiteness check of sklearn is skipped, as the model input is validated upstream.
+    An AveragingEnsemble of pipelines predicts with all members in parallel.
+    """
+    from sklearn import config_context
+
+    if hasattr(pipeline, "members"):
+        return pipeline.predict_members(lambda member: predict_feature_matrix(member, matrix))
+
+    X = matrix
+    with config_context(assume_finite=True):
+        for name, step in pipeline.steps[:-1]:
+            if name != "column_selector" and step != "passthrough":
+                X = step.transform(X)
+        return pipeline.steps[-1][1].predict(X)
+
+
+def _compile_estimator(estimator) -> Callable[[np.ndarray], np.ndarray]:
+    from sklearn.ensemble import RandomForestRegressor
+
+    if hasattr(estimator, "coef_") and hasattr(estimator, "intercept_") and np.ndim(estimator.coef_) == 1:
+        # Single target linear model.
+        coef = np.ascontiguousarray(estimator.coef_, dtype=np.float64)
+        intercept = float(np.ravel(estimator.intercept_)[0])
+        return lambda X: X @ coef + intercept
+    if isinstance(estimator, RandomForestRegressor) and estimator.n_outputs_ == 1:
+        # The trees predict on float32 input. This is what the forest does, minus validation and threading.
+        trees = [tree.tree_ for tree in estimator.estimators_]
+
+        def predict_forest(X: np.ndarray) -> np.ndarray:
+            X = np.ascontiguousarray(X, dtype=np.float32)
+            predictions = trees[0].predict(X)[:, 0].astype(np.float64)
+            for tree in trees[1:]:
+                predictions += tree.predict(X)[:, 0]
+            return predictions / len(trees)
+        return predict_forest
+
+    def predict(X: np.ndarray) -> np.ndarray:
+        from sklearn import config_context
+
+        with config_context(assume_finite=True):
+            return estimator.predict(X)
+    return predict
+
+
+def compile_predictor(pipeline) -> Callable[[np.ndarray], np.ndarray]:
+    """Turn a fitted pipeline into a function predicting on a feature matrix, for low latency on few rows.
+
+    The column selector is skipped, so the matrix columns must be in the order of its columns, and the
+    pipeline prepared with `prepare_matrix_pipeline`.
+    Linear models and random forests are evaluated directly from their fitted coefficients and trees,
+    other estimators are called with sklearn's input checks switched off where possible.
+    An AveragingEnsemble of pipelines is compiled member by member, and averaged.
+    """
+    if hasattr(pipeline, "members"):
+        member_predictors = [compile_predictor(member) for member in pipeline.members]
+        return lambda X: np.mean([predict(X) for predict in member_predictors], axis=0)
+
+    transforms = [
+        step.transform for name, step in pipeline.steps[:-1] if name != "column_selector" and step != "passthrough"
+    ]
+    predict_estimator = _compile_estimator(pipeline.steps[-1][1])
+
+    def predict(X: np.ndarray) -> np.ndarray:
+        for transform in transforms:
+            X = transform(X)
+        return predict_estimator(X)
+    return predict
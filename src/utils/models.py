@@ -1,11 +1,12 @@
 """utils for working with MLFlow and Azure ML."""
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Sequence, Union
 
+import mlflow.pyfunc
 import numpy as np
-import wandb
-import mlflow
 
-from src.exceptions import ArtifactDoesNoteExistError
+from src.utils.artifact_backends import ArtifactBackend, ArtifactVersion
+from src.utils.feature_matrix import compile_predictor, predict_feature_matrix, prepare_matrix_pipeline
 
 
 class MLFlowModelWrapper(mlflow.pyfunc.PythonModel):
@@ -34,39 +35,93 @@ class LoadedModel:
     """
     model: mlflow.pyfunc.PyFuncModel
     model_meta_data: ModelMetaData
-    wandb_artifact: wandb.Artifact
+    artifact: ArtifactVersion
+    backend: ArtifactBackend
+    _fast_predictor: Optional[Callable[[np.ndarray], np.ndarray]] = field(default=None, init=False, repr=False)
+    _feature_columns: Optional[List[str]] = field(default=None, init=False, repr=False)
+    _matrix_pipeline: Optional[object] = field(default=None, init=False, repr=False)
 
     @classmethod
-    def from_wandb_artifact(cls, wandb_artifact: wandb.Artifact):
-        """Get a `LoadedModel` from a wandb artifact"""
-        model_path = wandb_artifact.download()
+    def from_artifact(cls, artifact: ArtifactVersion, backend: ArtifactBackend):
+        """Get a `LoadedModel` from a model artifact"""
+        model_path = artifact.download()
         model = mlflow.pyfunc.load_model(f'file:{model_path}/model')
 
         model_meta_data = ModelMetaData(
-            model_id=wandb_artifact.id,
-            version=wandb_artifact.version,
-            run_id=wandb_artifact.logged_by(),
+            model_id=artifact.id,
+            version=artifact.version,
+            run_id=artifact.run_id,
         )
         return LoadedModel(
-            model=model, model_meta_data=model_meta_data, wandb_artifact=wandb_artifact
+            model=model, model_meta_data=model_meta_data, artifact=artifact, backend=backend
         )
 
-    def promote_to_prod(self):
-        """Promote model to production."""
-        self.wandb_artifact.aliases.append('prod')
-        self.wandb_artifact.save()
-
-
-def get_model(project_name: str, model_name: str, model_version: str) -> LoadedModel:
-    api = wandb.Api()
-    try:
-        model_artifact = api.artifact(f"{project_name}/{model_name}:{model_version}")
-    except wandb.errors.CommError as e:
-        raise ArtifactDoesNoteExistError(f"Trained model version does not exist. From WANDB: {e}")
+    @property
+    def pipeline(self):
+        """The fitted sklearn pipeline, or AveragingEnsemble of pipelines, wrapped by the mlflow pyfunc model."""
+        return self.model.unwrap_python_model().model
+
+    @property
+    def feature_columns(self) -> List[str]:
+        """Columns selected by the column selector of the fitted pipeline."""
+        if self._feature_columns is None:
+            self._feature_columns = list(self.pipeline["column_selector"].columns)
+        return self._feature_columns
+
+    @property
+    def matrix_pipeline(self):
+        """The pipeline prepared for predicting on feature matrices, see
+        src.utils.feature_matrix.prepare_matrix_pipeline. The column order is checked on first use."""
+        if self._matrix_pipeline is None:
+            self._matrix_pipeline = prepare_matrix_pipeline(self.pipeline, self.feature_columns)
+        return self._matrix_pipeline
+
+    def predict_matrix(self, matrix: np.ndarray) -> np.ndarray:
+        """Predict on a feature matrix with the columns in the order of `feature_columns`,
+        bypassing the pyfunc input conversion and the column selector.
+        See src.utils.feature_matrix for building the matrix.
+        """
+        if matrix.ndim != 2 or matrix.shape[1] != len(self.feature_columns):
+            raise ValueError(
+                f"Expected a matrix with {len(self.feature_columns)} feature columns, got shape {matrix.shape}."
+            )
+        return predict_feature_matrix(self.matrix_pipeline, matrix)
+
+    def predict_records(self, records: Union[Dict[str, float], Sequence[Dict[str, float]], np.ndarray]) -> np.ndarray:
+        """Low latency prediction for one or a few rows.
+
+        The pipeline is compiled into a plain function of the feature matrix on the first call, see
+        src.utils.feature_matrix.compile_predictor, so later calls skip the pyfunc wrapper, dataframe
+        construction, column selection and sklearn's input validation.
+        :records: A record or a list of records, as dictionaries from feature name to value,
+            or a numpy array of one or more rows with the columns in the order of `feature_columns`.
+        Raises ValueError if a record misses feature columns.
+        """
+        if self._fast_predictor is None:
+            self._fast_predictor = compile_predictor(self.matrix_pipeline)
+        columns = self.feature_columns
+        if isinstance(records, np.ndarray):
+            matrix = np.atleast_2d(records).astype(np.float64, copy=False)
+            if matrix.ndim != 2 or matrix.shape[1] != len(columns):
+                raise ValueError(f"Expected rows with {len(columns)} feature columns, got shape {records.shape}.")
+        else:
+            if isinstance(records, dict):
+                records = [records]
+            try:
+                matrix = np.array([[record[column] for column in columns] for record in records], dtype=np.float64)
+            except KeyError:
+                missing = sorted({column for record in records for column in columns if column not in record})
+                raise ValueError(f"Records are missing the feature columns {missing}.") from None
+        return self._fast_predictor(matrix)
 
-    return LoadedModel.from_wandb_artifact(model_artifact)
+    def promote_to_prod(self):
+        """Promote model to production. Cached resolutions of the prod alias are invalidated."""
+        self.backend.promote(self.artifact.name, self.artifact.version, 'prod')
+        self.backend.invalidate(self.artifact.name)
 
 
-def set_seed(seed=33):
-    np.random.seed(seed)
-    return seed
+def get_model(backend: ArtifactBackend, model_name: str, model_version: str) -> LoadedModel:
+    """Load a model version. `model_version` can be a version, like v3, or an alias, like prod.
+    Raises ArtifactDoesNoteExistError if the version does not exist.
+    """
+    return LoadedModel.from_artifact(backend.get_artifact(model_name, model_version), backend)
@@ -0,0 +1,129 @@
+"""
+Append-only store of batch predictions.
+
+Instead of logging a copy of the full model input with the predictions as an artifact per batch,
+every batch appends two slim tables to a single parquet dataset, partitioned by date and batch:
+- predictions: row key, prediction, dictionary encoded model version, and whether the model is a shadow model.
+- features: row key and the feature columns the models use, for drift detection and monitoring.
+
+The dataset is laid out as <root>/<table>/date=<YYYY-MM-DD>/batch=<batch id>/<part>.parquet.
+Readers select a rolling window of dates, and only the partitions in the window are read.
+"""
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+import uuid
+
+import numpy as np
+import pandas as pd
+
+PREDICTIONS_TABLE = "predictions"
+FEATURES_TABLE = "features"
+PARTITION_COLUMNS = ["date", "batch"]
+
+
+def get_row_keys(df: pd.DataFrame, key_columns: Optional[List[str]] = None) -> np.ndarray:
+    """Get a 64 bit key for every row, hashed from the key columns. The index is used if there are none."""
+    if key_columns:
+        return pd.util.hash_pandas_object(df[list(key_columns)], index=False).to_numpy()
+    return pd.util.hash_pandas_object(df.index, index=False).to_numpy()
+
+
+class PredictionsStore:
+    """Append-only parquet dataset of predictions and features, partitioned by date and batch.
+
+    :root: Root directory of the dataset.
+    """
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+
+    def _append(self, table_name: str, table, batch_id: str, batch_date: Optional[date]) -> None:
+        import pyarrow.parquet as pq
+
+        batch_date = batch_date or datetime.now(timezone.utc).date()
+        partition_dir = self.root / table_name / f"date={batch_date.isoformat()}" / f"batch={batch_id}"
+        partition_dir.mkdir(parents=True, exist_ok=True)
+        # Written under a hidden name and renamed, so readers never see partial files.
+        part_name = uuid.uuid4().hex
+        tmp_path = partition_dir / f".{part_name}.tmp"
+        pq.write_table(table, tmp_path)
+        tmp_path.replace(partition_dir / f"{part_name}.parquet")
+
+    def append_predictions(
+        self,
+        row_keys: np.ndarray,
+        predictions: Dict[str, np.ndarray],
+        production_version: str,
+        batch_id: str,
+        batch_date: Optional[date] = None,
+    ) -> None:
+        """Append the predictions of a batch.
+
+        :row_keys: Key of every row, see `get_row_keys`.
+        :predictions: Dictionary from model version to its predictions for the rows.
+        :production_version: Version of the production model. The other versions are stored as shadow models.
+        """
+        import pyarrow as pa
+
+        versions = list(predictions)
+        n_rows = len(row_keys)
+        table = pa.table({
+            "row_key": pa.array(np.tile(row_keys, len(versions)), type=pa.uint64()),
+            "prediction": pa.array(np.concatenate([predictions[version] for version in versions]), type=pa.float64()),
+            "model_version": pa.DictionaryArray.from_arrays(
+                pa.array(np.repeat(np.arange(len(versions), dtype=np.int32), n_rows)),
+                pa.array(versions, type=pa.string()),
+            ),
+            "shadow": pa.array(np.repeat([version != production_version for version in versions], n_rows)),
+        })
+        self._append(PREDICTIONS_TABLE, table, batch_id, batch_date)
+
+    def append_features(
+        self, row_keys: np.ndarray, features: pd.DataFrame, batch_id: str, batch_date: Optional[date] = None
+    ) -> None:
+        """Append the features of a batch.
+
+        Numeric features are stored as float64, whatever the dtype policy of the batch, so all
+        partitions share one schema and can be read together.
+        """
+        import pyarrow as pa
+
+        numeric_columns = features.select_dtypes(include="number").columns
+        features = features.astype({column: np.float64 for column in numeric_columns})
+        table = pa.Table.from_pandas(features, preserve_index=False)
+        table = table.add_column(0, "row_key", pa.array(row_keys, type=pa.uint64()))
+        self._append(FEATURES_TABLE, table, batch_id, batch_date)
+
+    def read_window(
+        self,
+        table_name: str,
+        days: int,
+        until: Optional[date] = None,
+        columns: Optional[List[str]] = None,
+    ) -> pd.DataFrame:
+        """Read the rows of a table from the `days` dates up to and including `until` (default today, UTC).
+
+        Only the partitions of the dates in the window are read.
+        :columns: Columns to read. All columns, except the partition columns, if None.
+        """
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+
+        table_dir = self.root / table_name
+        if not table_dir.exists():
+            raise FileNotFoundError(f"No {table_name} in the predictions store at {self.root}.")
+        until = until or datetime.now(timezone.utc).date()
+        start = until - timedelta(days=days - 1)
+
+        dataset = ds.dataset(
+            table_dir,
+            format="parquet",
+            partitioning=ds.partitioning(pa.schema([("date", pa.string()), ("batch", pa.string())]), flavor="hive"),
+            exclude_invalid_files=False,
+            ignore_prefixes=["."],
+        )
+        if columns is None:
+            columns = [name for name in dataset.schema.names if name not in PARTITION_COLUMNS]
+        window = (ds.field("date") >= start.isoformat()) & (ds.field("date") <= until.isoformat())
+        return dataset.to_table(columns=columns, filter=window).to_pandas()
@@ -0,0 +1,7 @@
+"""Utilities for making runs reproducible."""
+import numpy as np
+
+
+def set_seed(seed=33):
+    np.random.seed(seed)
+    return seed